@@ -1,121 +1,401 @@
-from typing import List
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, groupby, repeat
+from operator import itemgetter
+from typing import List, Tuple
 from database_api import *
-from datetime import datetime, timedelta
+from datetime import date, datetime
 from functools import reduce
+import instrumentation
+from periods import epoch_seconds, period_calendar, period_key_function, within_one_period
 
+try:
+    import numpy
+except ImportError:  # optional, the reduce-based functions below work without it
+    numpy = None
 
-def longest_streak(habit):
+
+# "numpy" or "python"; the vectorized backend is picked automatically when NumPy is installed.
+STREAK_BACKEND = "numpy" if numpy is not None else "python"
+
+# Processes used by parallel_streaks(); HABITS_ANALYTICS_WORKERS overrides the default of one per core.
+ANALYTICS_WORKERS = int(os.environ.get("HABITS_ANALYTICS_WORKERS", 0)) or None
+# Below this many habits parallel_streaks() runs serially, starting a process pool would cost more than it saves.
+PARALLEL_MIN_HABITS = 2_000
+# Habit id ranges handed out per worker, so a slow range does not leave the other workers idle.
+PARTITIONS_PER_WORKER = 4
+
+
+def _numpy_run_lengths(period_keys, step_size_between_periods):
     """
-    Longest streak recorded historically.
+    Lengths of the runs of consecutive period keys, oldest run first.
     """
-    completion_timestamp_string_list = get_completed_habits(habit.name)
-    completion_datetime_object_list = list(map(lambda timestamp_str: datetime.fromisoformat(timestamp_str), completion_timestamp_string_list))
-    periodicity_value = habit.periodicity
+    breaks = numpy.flatnonzero(numpy.diff(period_keys) != step_size_between_periods) + 1
+    return numpy.diff(numpy.concatenate(([0], breaks, [len(period_keys)])))
 
-    if periodicity_value == "daily":
-        convert_datetime_to_period_key = lambda date_and_time: date_and_time.date().toordinal()
-        step_size_between_periods = 1
-    elif periodicity_value == "weekly":
-        convert_datetime_to_period_key = lambda date_and_time: (date_and_time - timedelta(days=date_and_time.weekday())).date().toordinal()
-        step_size_between_periods = 7
-    else:  # "monthly"
-        convert_datetime_to_period_key = lambda date_and_time: date_and_time.year * 12 + date_and_time.month
-        step_size_between_periods = 1
 
-    sorted_period_key_list = sorted(map(convert_datetime_to_period_key, completion_datetime_object_list))
-    sorted_period_key_list = sorted(set(sorted_period_key_list))
-    if not sorted_period_key_list:
-        return 0
+def _numpy_streak_state(rollup_batches, periodicity):
+    """
+    Streak state (see compute_streak_state) from batches of period rollup rows in period order, vectorized per batch.
+    Runs crossing a batch boundary are joined, so only one batch is in memory at a time.
+    """
+    _, step_size_between_periods = period_key_function(periodicity)
 
-    initial_streak = (None, 0, 0)
-    _, _, longest_streak = reduce(
-        lambda state, key: (
-            key,
-            (1 if state[0] is None or (key - state[0]) != step_size_between_periods else state[1] + 1),
-            max((1 if state[0] is None or (key - state[0]) != step_size_between_periods else state[1] + 1), state[2])
-        ),
-        sorted_period_key_list,
-        initial_streak
-    )
-    return longest_streak
-
-
-def current_streak(habit):
-    """
-    Current streak ending at the most recent completion.
-    """
-    completion_timestamp_string_list = get_completed_habits(habit.name)
-    completion_datetime_object_list = list(map(lambda timestamp_str: datetime.fromisoformat(timestamp_str), completion_timestamp_string_list))
-    periodicity_value = habit.periodicity
-    now_datetime_object = datetime.now()
-
-    if periodicity_value == "daily":
-        convert_datetime_to_period_key = lambda date_and_time: date_and_time.date().toordinal()
-        step_size_between_periods = 1
-        one_period_timedelta = lambda most_recent: (now_datetime_object - most_recent) <= timedelta(days=1)
-    elif periodicity_value == "weekly":
-        convert_datetime_to_period_key = lambda date_and_time: (date_and_time - timedelta(days=date_and_time.weekday())).date().toordinal()
-        step_size_between_periods = 7
-        one_period_timedelta = lambda most_recent: (now_datetime_object - most_recent) <= timedelta(weeks=1)
-    else:  # "monthly"
-        convert_datetime_to_period_key = lambda date_and_time: date_and_time.year * 12 + date_and_time.month
-        step_size_between_periods = 1
-        one_period_timedelta = lambda most_recent: (convert_datetime_to_period_key(now_datetime_object) - convert_datetime_to_period_key(most_recent)) <= 1
-
-    if not completion_datetime_object_list:
-        return 0
+    last_key, run, longest, most_recent = None, 0, 0, None
+    for rollup_rows in rollup_batches:
+        most_recent = rollup_rows[-1]
+        period_keys = numpy.fromiter((row[0] for row in rollup_rows), dtype=numpy.int64, count=len(rollup_rows))
+        run_lengths = _numpy_run_lengths(period_keys, step_size_between_periods)
+        if last_key is not None and period_keys[0] - last_key == step_size_between_periods:
+            run_lengths[0] += run
+        longest = max(longest, int(run_lengths.max()))
+        last_key, run = int(period_keys[-1]), int(run_lengths[-1])
+
+    if most_recent is None:
+        return None
+    return last_key, most_recent[3], most_recent[4], run, longest
+
+
+def compute_streak_state(habit):
+    """
+    Recomputes a habit's streak state from its period rollups:
+    (last period key, last completed_epoch, last completed_day, run ending at the last key, longest run).
+    Returns None when the habit has no completions. Work is per completed period, not per completion,
+    and rollups are streamed, so memory does not grow with history.
+    """
+    rollup_batches = iter_period_rollup_batches(habit.id, habit.user_id)
+    if STREAK_BACKEND == "numpy":
+        return _numpy_streak_state(rollup_batches, habit.periodicity)
+    return streak_state_from_completions(((row[3], row[4]) for row in chain.from_iterable(rollup_batches)),
+                                         habit.periodicity)
 
-    completion_datetime_object_list.sort()
-    most_recent = completion_datetime_object_list[-1]
-    if not one_period_timedelta(most_recent):
+
+def _streak_state(habit):
+    """
+    Reads the persisted streak state, recomputing and storing it when it was invalidated.
+    """
+    state = get_streak_state(habit.id, habit.user_id)
+    if state is None:
+        state = compute_streak_state(habit)
+        if state is not None:
+            save_streak_state(habit.id, state, habit.user_id)
+    return state
+
+
+def longest_streak(habit, as_of=None):
+    """
+    Longest streak recorded historically, or up to the datetime as_of.
+    """
+    if as_of is not None:
+        return streak_as_of(habit, as_of)[0]
+    state = _streak_state(habit)
+    return state[4] if state else 0
+
+
+def current_streak(habit, as_of=None):
+    """
+    Current streak ending at the most recent completion, now in the user's timezone or as it stood at the
+    datetime as_of.
+    """
+    if as_of is not None:
+        return streak_as_of(habit, as_of)[1]
+    state = _streak_state(habit)
+    if state is None or not within_one_period(habit.periodicity, state[1], state[2], user_now(habit.user_id)):
         return 0
+    return state[3]
 
-    sorted_keys = sorted(map(convert_datetime_to_period_key, completion_datetime_object_list))
-    sorted_keys = sorted(set(sorted_keys))
-    last_key = sorted_keys[-1]
 
-    keys_to_reduce = list(reversed(sorted_keys[:-1]))
-    initial_streak = (1, last_key, True)
-    current_run, _, _ = reduce(
-        lambda state, key: state if not state[2] else (
-            (state[0] + 1, key, True) if key == state[1] - step_size_between_periods else (state[0], key, False)
-        ),
-        keys_to_reduce,
-        initial_streak
-    )
-    return current_run
+def streak_series(habit, points) -> List[Tuple[datetime, int, int]]:
+    """
+    Return (point, longest streak, current streak) as the streaks stood at each datetime in points, oldest first,
+    counting only completions made up to that point. One pass over the habit's completions serves all points,
+    with period keys looked up in a precomputed calendar instead of being converted per completion.
+    """
+    points = sorted(points)
+    completions = chain.from_iterable(iter_completion_batches(habit.id, habit.user_id))
+    row = next(completions, None)
+    if not points or row is None:
+        return [(point, 0, 0) for point in points]
 
+    _, step_size_between_periods = period_key_function(habit.periodicity)
+    first_day = min(row[1], points[0].toordinal())
+    calendar = period_calendar(habit.periodicity, first_day, max(row[1], points[-1].toordinal()))
 
-def all_habit_names() -> List[str]:
+    series = []
+    last_key, run, longest, most_recent = None, 0, 0, None
+    for point in points:
+        point_epoch = epoch_seconds(point)
+        while row is not None and row[0] <= point_epoch:
+            key = calendar[row[1] - first_day]
+            if key != last_key:
+                run = run + 1 if last_key is not None and key - last_key == step_size_between_periods else 1
+                longest = max(longest, run)
+                last_key = key
+            most_recent = row
+            row = next(completions, None)
+        running = most_recent is not None and within_one_period(habit.periodicity, most_recent[0], most_recent[1], point)
+        series.append((point, longest, run if running else 0))
+    return series
+
+
+def streak_as_of(habit, as_of) -> Tuple[int, int]:
+    """
+    Return (longest streak, current streak) as they stood at the datetime as_of.
+    """
+    _, longest, current = streak_series(habit, [as_of])[0]
+    return longest, current
+
+
+def all_streak_series(points, user_id=DEFAULT_USER_ID) -> List[Tuple[Habit, List[Tuple[datetime, int, int]]]]:
+    """
+    Return (habit, streak_series(habit, points)) for every habit of the user,
+    e.g. with points=periods.period_ends("weekly", first_date, last_date) for a weekly report.
+    """
+    points = sorted(points)
+    return [(habit, streak_series(habit, points)) for habit in get_all_habits(user_id)]
+
+
+def all_habit_names(user_id=DEFAULT_USER_ID) -> List[str]:
     """
     Return a list of all habit names.
     """
-    return list(map(lambda habit: habit.name, get_all_habits()))
+    return list(map(lambda habit: habit.name, iter_habits(user_id)))
 
 
-def habits_by_periodicity(periodicity) -> List[str]:
+def habits_by_periodicity(periodicity, user_id=DEFAULT_USER_ID) -> List[str]:
     """
     Return a list of habit names sorted by habit periodicity.
     """
-    habits = get_habits_by_periodicity(periodicity)
-    if isinstance(habits, list):
-        return [getattr(habit, 'name', habit[1]) for habit in habits]
-    return [getattr(habits, 'name', habits[1])]
+    return [habit.name for habit in iter_habits(user_id, periodicity)]
+
+
+def streak_state_from_completions(completion_rows, periodicity):
+    """
+    Streak state (see compute_streak_state) in one pass over (completed_epoch, completed_day) rows sorted ascending.
+    """
+    convert_day_to_period_key, step_size_between_periods = period_key_function(periodicity)
+
+    last_key, run, longest, most_recent = None, 0, 0, None
+    for most_recent in completion_rows:
+        key = convert_day_to_period_key(most_recent[1])
+        if key == last_key:
+            continue
+        run = run + 1 if last_key is not None and key - last_key == step_size_between_periods else 1
+        longest = max(longest, run)
+        last_key = key
+
+    if most_recent is None:
+        return None
+    return last_key, most_recent[0], most_recent[1], run, longest
+
+
+def rebuild_streak_state(user_id=DEFAULT_USER_ID):
+    """
+    Recomputes the persisted streak state of every habit of the user from its period rollups in one ordered scan.
+    """
+    return rebuild_streak_states(streak_state_from_completions, user_id)
+
+
+def habit_streak_states(user_id=DEFAULT_USER_ID) -> List[Tuple[Habit, tuple]]:
+    """
+    Return (habit, persisted streak state or None) for every habit of the user.
+    Invalidated states are rebuilt first with a single ordered scan of the period rollups.
+    """
+    if count_missing_streak_states(user_id):
+        rebuild_streak_state(user_id)
+    states = get_all_streak_states(user_id)
+    return [(habit, states.get(habit.id)) for habit in iter_habits(user_id)]
+
+
+def _streaks_at(habit_states, now_datetime_object) -> List[Tuple[Habit, int, int]]:
+    """
+    (habit, longest streak, current streak) from (habit, streak state) pairs, current as of now_datetime_object.
+    """
+    streaks = []
+    for habit, state in habit_states:
+        if state is None:
+            streaks.append((habit, 0, 0))
+        elif within_one_period(habit.periodicity, state[1], state[2], now_datetime_object):
+            streaks.append((habit, state[4], state[3]))
+        else:
+            streaks.append((habit, state[4], 0))
+    return streaks
+
+
+def all_streaks(user_id=DEFAULT_USER_ID) -> List[Tuple[Habit, int, int]]:
+    """
+    Return (habit, longest streak, current streak) for every habit of the user.
+    Reads the persisted streak states; invalidated ones are rebuilt with a single ordered scan of completions.
+    """
+    return _streaks_at(habit_streak_states(user_id), user_now(user_id))
+
+
+def _window(days, today, user_id):
+    """
+    First and last day ordinal of the `days` days ending today in the user's timezone (or at the given date);
+    all history for None.
+    """
+    last_day = (today or user_now(user_id).date()).toordinal()
+    return (1 if days is None else last_day - days + 1), last_day
+
+
+def completion_rates(days=90, user_id=DEFAULT_USER_ID, today=None) -> List[Tuple[Habit, int, int, float]]:
+    """
+    Return (habit, completed periods, missed periods, completion rate) for every habit of the user over the
+    last `days` days. Periods before a habit was created (or first completed) are not due, and neither is
+    the current period until it is completed.
+    """
+    first_day, last_day = _window(days, today, user_id)
+    summaries = summarize_completed_periods(first_day, last_day, user_id)
 
+    rates = []
+    for habit in iter_habits(user_id):
+        convert_day_to_period_key, step_size_between_periods = period_key_function(habit.periodicity)
+        completed, first_completed, last_completed = summaries.get(habit.id, (0, None, None))
+        created_day = date.fromisoformat(habit.created_at[:10]).toordinal()
+        start = max(first_day, min(created_day, first_completed or created_day))
+        due = 0
+        if start <= last_day:
+            due = (convert_day_to_period_key(last_day) - convert_day_to_period_key(start)) // step_size_between_periods
+            if last_completed is not None and convert_day_to_period_key(last_completed) == convert_day_to_period_key(last_day):
+                due += 1
+        rates.append((habit, completed, due - completed, completed / due if due else 0.0))
+    return rates
 
-def max_overall_streak() -> int:
+
+def _histogram(bucket, size, days, habit, user_id, today):
+    first_day, last_day = _window(days, today, habit.user_id if habit is not None else user_id)
+    if habit is not None:
+        counts = count_completions_by(bucket, first_day, last_day, habit.user_id, habit.id)
+    else:
+        counts = count_completions_by(bucket, first_day, last_day, user_id)
+    return [counts.get(index, 0) for index in range(size)]
+
+
+def weekday_histogram(days=None, habit=None, user_id=DEFAULT_USER_ID, today=None) -> List[int]:
     """
-    Return the maximum streak overall.
+    Return the number of completions per weekday, Monday first, of one habit or all the user's habits
+    over the last `days` days (all history by default).
     """
-    return reduce(lambda accumulator, habit: max(accumulator, longest_streak(habit)), get_all_habits(), 0)
+    return _histogram("weekday", 7, days, habit, user_id, today)
+
+
+def month_histogram(days=None, habit=None, user_id=DEFAULT_USER_ID, today=None) -> List[int]:
+    """
+    Return the number of completions per calendar month, January first, of one habit or all the user's habits
+    over the last `days` days (all history by default).
+    """
+    return _histogram("month", 12, days, habit, user_id, today)
+
+
+def rolling_completions(habit, window_days=7, days=90, today=None) -> List[Tuple[date, int]]:
+    """
+    Return (day, days completed in the window_days ending that day) for each of the last `days` days.
+    """
+    first_day, last_day = _window(days, today, habit.user_id)
+    return [(date.fromordinal(day), completed_days)
+            for day, completed_days in rolling_completed_days(habit.id, first_day, last_day, window_days, habit.user_id)]
+
+
+def _partition_streak_states(path, user_id, first_id, last_id):
+    """
+    Worker process: {habit_id: streak state} for the user's habits with ids in first_id..last_id,
+    computed from their period rollups over a read-only connection of its own.
+    """
+    connection = open_read_only(path)
+    try:
+        periodicity_by_id = dict(connection.execute(
+            "SELECT id, periodicity FROM habits WHERE user_id = ? AND id BETWEEN ? AND ?",
+            (user_id, first_id, last_id)))
+        rollups = connection.execute("""
+            SELECT period_rollups.habit_id, period_rollups.last_epoch, period_rollups.last_day
+            FROM habits
+            JOIN period_rollups ON period_rollups.habit_id = habits.id
+            WHERE habits.user_id = ? AND habits.id BETWEEN ? AND ?
+            ORDER BY period_rollups.habit_id, period_rollups.period_key
+            """, (user_id, first_id, last_id))
+        states = {}
+        for habit_id, rows in groupby(rollups, key=itemgetter(0)):
+            periodicity = periodicity_by_id.get(habit_id)
+            if periodicity is not None:
+                states[habit_id] = streak_state_from_completions(map(itemgetter(1, 2), rows), periodicity)
+        return states
+    finally:
+        connection.close()
+
+
+def parallel_streak_states(user_id=DEFAULT_USER_ID, workers=None, min_habits=PARALLEL_MIN_HABITS) \
+        -> List[Tuple[Habit, tuple]]:
+    """
+    Same result as habit_streak_states(), computed from the period rollups with the habits split into id ranges
+    across a pool of worker processes. Falls back to habit_streak_states() for a single worker, fewer than
+    min_habits habits, or inside a snapshot(), which the worker processes could not see.
+    """
+    habits = get_all_habits(user_id)
+    workers = workers or ANALYTICS_WORKERS or os.cpu_count() or 1
+    if workers <= 1 or len(habits) < max(min_habits, 1) or in_snapshot(database_path(user_id)):
+        return habit_streak_states(user_id)
+
+    habit_ids = [habit.id for habit in habits]
+    size = -(-len(habit_ids) // (workers * PARTITIONS_PER_WORKER))
+    first_ids = habit_ids[::size]
+    last_ids = [habit_ids[min(start + size, len(habit_ids)) - 1] for start in range(0, len(habit_ids), size)]
+
+    states = {}
+    with ProcessPoolExecutor(min(workers, len(first_ids))) as pool:
+        for partition in pool.map(_partition_streak_states, repeat(database_path(user_id)), repeat(user_id),
+                                  first_ids, last_ids):
+            states.update(partition)
+    return [(habit, states.get(habit.id)) for habit in habits]
+
+
+def parallel_streaks(user_id=DEFAULT_USER_ID, workers=None, min_habits=PARALLEL_MIN_HABITS) \
+        -> List[Tuple[Habit, int, int]]:
+    """
+    Same result as all_streaks(), with the habits split across worker processes by parallel_streak_states().
+    """
+    return _streaks_at(parallel_streak_states(user_id, workers, min_habits), user_now(user_id))
+
+
+def cached_streaks(user_id=DEFAULT_USER_ID, workers=None) -> List[Tuple[Habit, int, int]]:
+    """
+    Same result as parallel_streaks(), reusing the streak states while nothing was written (see cached_read()).
+    Current streaks are still evaluated at the current time on every call.
+    """
+    return _streaks_at(cached_read(parallel_streak_states, user_id=user_id, workers=workers), user_now(user_id))
+
+
+def max_overall_streak(user_id=DEFAULT_USER_ID, workers=1) -> int:
+    """
+    Return the maximum streak overall. More than one worker computes the streaks with parallel_streaks().
+    """
+    streaks = all_streaks(user_id) if workers == 1 else parallel_streaks(user_id, workers)
+    return reduce(lambda accumulator, streaks: max(accumulator, streaks[1]), streaks, 0)
 
 
 if __name__ == "__main__":
-    habits = get_all_habits()
+    parser = argparse.ArgumentParser(description="Print the longest streak of every habit.")
+    parser.add_argument("command", nargs="?", choices=["rebuild"],
+                        help="recompute the period rollups and cached streak states")
+    parser.add_argument("--workers", type=int, help="worker processes for large habit sets (default: one per core)")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="report from an in-memory copy, so check-offs never wait for the report")
+    arguments = parser.parse_args()
+    instrumentation.install_from_environment()
+    if arguments.command == "rebuild":
+        print(f"Rebuilt {rebuild_period_rollups()} period rollups.")
+        print(f"Rebuilt the streak state of {rebuild_streak_state()} habits.")
+        raise SystemExit
+
+    if arguments.snapshot:
+        with snapshot():
+            streaks = all_streaks()
+    else:
+        streaks = parallel_streaks(workers=arguments.workers)
 
-    if not habits:
+    if not streaks:
         print("No habits found.")
     else:
-        for habit in habits:
-            streak = longest_streak(habit)
+        for habit, streak, _ in streaks:
             print(f"Habit: {habit.name} — Longest Streak: {streak}")
@@ -0,0 +1,103 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import database
+import database_api
+from habit import Habit
+
+# How long check-offs are collected before they are written together in one transaction.
+BATCH_WINDOW_SECONDS = 0.005
+
+
+class AsyncHabitStore:
+    """
+    asyncio front end for the habit data layer.
+    All SQLite work runs on one dedicated thread, which keeps a single pooled connection for its lifetime,
+    and check-offs that arrive close together are written in one transaction.
+    Results are returned instead of printed.
+    """
+
+    def __init__(self, path=None, batch_window=BATCH_WINDOW_SECONDS):
+        self.__batch_window = batch_window
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="habits-sqlite",
+                                             initializer=database.use_database, initargs=(path,))
+        self.__pending_check_offs = []
+        self.__flush_task = None
+
+    def __call(self, function, *args):
+        """
+        Runs a database_api function on the database thread.
+        """
+        return asyncio.get_running_loop().run_in_executor(self.__executor, function, *args)
+
+    async def create_habit(self, name, description, priority, periodicity,
+                           user_id=database.DEFAULT_USER_ID) -> Habit | None:
+        """
+        Creates a habit; None if the user already has one with that name.
+        """
+        return await self.__call(database_api.add_habit, name, description, priority, periodicity, user_id)
+
+    async def get_habit(self, identifier, user_id=database.DEFAULT_USER_ID) -> Habit | None:
+        return await self.__call(database_api.get_habit, identifier, user_id)
+
+    async def get_all_habits(self, user_id=database.DEFAULT_USER_ID) -> list:
+        return await self.__call(database_api.get_all_habits, user_id)
+
+    async def update_habit(self, identifier, user_id=database.DEFAULT_USER_ID, **changes) -> Habit | None:
+        """
+        Changes name, description, priority and/or periodicity; None if the habit does not exist.
+        """
+        return await self.__call(partial(database_api.edit_habit, identifier, user_id=user_id, **changes))
+
+    async def remove_habit(self, name, user_id=database.DEFAULT_USER_ID) -> bool:
+        return await self.__call(database_api.delete_habit, name, user_id)
+
+    async def get_completions(self, name, user_id=database.DEFAULT_USER_ID) -> list:
+        return await self.__call(database_api.get_completed_habits, name, user_id)
+
+    async def check_off(self, name, user_id=database.DEFAULT_USER_ID) -> str:
+        """
+        Checks off a habit as done today; returns database_api.CHECKED, ALREADY_CHECKED or NOT_FOUND.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.__pending_check_offs.append((user_id, name, future))
+        if self.__flush_task is None:
+            self.__flush_task = asyncio.create_task(self.__flush_check_offs())
+        return await future
+
+    async def __flush_check_offs(self):
+        await asyncio.sleep(self.__batch_window)
+        batch, self.__pending_check_offs = self.__pending_check_offs, []
+        self.__flush_task = None
+        # one transaction per user, since users may live in different database shards
+        by_user = {}
+        for user_id, name, future in batch:
+            by_user.setdefault(user_id, []).append((name, future))
+        for user_id, check_offs in by_user.items():
+            try:
+                statuses = await self.__call(database_api.check_off_habits, [name for name, _ in check_offs], user_id)
+            except Exception as error:
+                for _, future in check_offs:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            # a caller may have cancelled its wait, the others must still get their status
+            for (_, future), status in zip(check_offs, statuses):
+                if not future.done():
+                    future.set_result(status)
+
+    async def close(self):
+        """
+        Writes pending check-offs, then closes the database thread and its connection.
+        """
+        if self.__flush_task is not None:
+            await self.__flush_task
+        await self.__call(database.close_connection)
+        self.__executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
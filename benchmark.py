@@ -0,0 +1,206 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+
+import database
+import instrumentation
+from database import close_connection, create_table, get_connection
+from database_api import clear_habit_cache
+
+PERIOD_DAYS = {"daily": 1, "weekly": 7, "monthly": 30}
+DEFAULT_MIX = {"daily": 0.6, "weekly": 0.3, "monthly": 0.1}
+CHUNK_SIZE = 50_000
+
+
+def parse_mix(text) -> dict:
+    """
+    Parses "daily=0.6,weekly=0.3,monthly=0.1" into a periodicity -> share mapping.
+    """
+    mix = {}
+    for part in text.split(","):
+        periodicity, share = part.split("=")
+        if periodicity not in PERIOD_DAYS:
+            raise ValueError(f"Unknown periodicity '{periodicity}'")
+        mix[periodicity] = float(share)
+    return mix
+
+
+def _synthetic_completions(habits, completions_per_habit, skip_rate, rng, today):
+    """
+    Yields (habit_id, completed_at) walking back from today one period at a time, skipping some periods.
+    """
+    for habit_id, periodicity in habits:
+        moment = today
+        for _ in range(completions_per_habit):
+            if rng.random() >= skip_rate:
+                yield habit_id, moment.replace(hour=rng.randrange(6, 23), minute=rng.randrange(60)).isoformat()
+            moment -= timedelta(days=PERIOD_DAYS[periodicity])
+
+
+def generate_database(path, habits=1_000, completions=100_000, mix=None, skip_rate=0.1, seed=42):
+    """
+    Creates a synthetic habits database at path with the given habit count, periodicity mix and
+    roughly `completions` completions spread evenly across habits.
+    """
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    close_connection(path)
+    clear_habit_cache()
+    for leftover in [path, path + "-wal", path + "-shm"]:
+        if os.path.exists(leftover):
+            os.remove(leftover)
+    original, database.DATABASE = database.DATABASE, path
+    try:
+        create_table()
+        connection = get_connection()
+        created_at = datetime(2000, 1, 1).isoformat()
+        periodicities = rng.choices(list(mix), weights=list(mix.values()), k=habits)
+        connection.executemany(
+            "INSERT INTO habits (name, description, priority, periodicity, created_at) VALUES (?, ?, ?, ?, ?)",
+            ((f"habit-{number}", "synthetic", rng.randint(1, 5), periodicity, created_at)
+             for number, periodicity in enumerate(periodicities)))
+        connection.commit()
+
+        habit_rows = connection.execute("SELECT id, periodicity FROM habits ORDER BY id").fetchall()
+        per_habit = max(1, round(completions / (habits * (1 - skip_rate))))
+        today = datetime.now().replace(microsecond=0)
+        rows = _synthetic_completions(habit_rows, per_habit, skip_rate, rng, today)
+        while True:
+            chunk = list(islice(rows, CHUNK_SIZE))
+            if not chunk:
+                break
+            connection.executemany("INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)", chunk)
+            connection.commit()
+        return connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+    finally:
+        close_connection(path)
+        database.DATABASE = original
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _time_calls(function, arguments):
+    """
+    Calls function once per argument tuple and summarises the latencies in milliseconds.
+    """
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for argument in arguments:
+            started = time.perf_counter()
+            function(*argument)
+            latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    total_seconds = sum(latencies) / 1000
+    return {
+        "calls": len(latencies),
+        "mean_ms": round(statistics.fmean(latencies), 4),
+        "p50_ms": round(_percentile(latencies, 0.50), 4),
+        "p99_ms": round(_percentile(latencies, 0.99), 4),
+        "throughput_per_s": round(len(latencies) / total_seconds, 2) if total_seconds else None,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(path, samples=100, seed=42) -> dict:
+    """
+    Times the data access and analytics functions against the database at path.
+    check_off_habit() writes to the database, so compare runs on freshly generated databases.
+    """
+    import analytics
+
+    rng = random.Random(seed)
+    original, database.DATABASE = database.DATABASE, path
+    try:
+        habits = analytics.get_all_habits()
+        picked = [rng.choice(habits) for _ in range(samples)]
+        results = {
+            "get_all_habits": _time_calls(analytics.get_all_habits, [()] * max(1, samples // 10)),
+            "get_completed_habits": _time_calls(analytics.get_completed_habits, [(habit.name,) for habit in picked]),
+            "compute_streak_state": _time_calls(analytics.compute_streak_state, [(habit,) for habit in picked]),
+            # leaves every streak state warm, so the reads below time the same path on every run
+            "rebuild_streak_state": _time_calls(analytics.rebuild_streak_state, [()]),
+            "longest_streak": _time_calls(analytics.longest_streak, [(habit,) for habit in picked]),
+            "current_streak": _time_calls(analytics.current_streak, [(habit,) for habit in picked]),
+            "max_overall_streak": _time_calls(analytics.max_overall_streak, [()] * max(1, samples // 100)),
+            "completion_rates": _time_calls(analytics.completion_rates, [()] * max(1, samples // 100)),
+            "check_off_habit": _time_calls(analytics.check_off_habit,
+                                           [(habit.name,) for habit in rng.sample(habits, min(samples, len(habits)))]),
+        }
+        completions = get_connection().execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+    finally:
+        close_connection(path)
+        database.DATABASE = original
+
+    return {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().replace(microsecond=0).isoformat(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "habits": len(habits),
+        "completions": completions,
+        "samples": samples,
+        "results": results,
+    }
+
+
+def compare(current, baseline, tolerance=0.2) -> dict:
+    """
+    Ratio of current to baseline p50 per function; ratios above 1 + tolerance are flagged as regressions.
+    """
+    comparison = {}
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if before and before["p50_ms"]:
+            ratio = result["p50_ms"] / before["p50_ms"]
+            comparison[name] = {"ratio": round(ratio, 3), "regression": ratio > 1 + tolerance}
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the habit tracker on a synthetic database.")
+    parser.add_argument("--database", default="benchmark.db", help="synthetic database path")
+    parser.add_argument("--habits", type=int, default=1_000)
+    parser.add_argument("--completions", type=int, default=100_000, help="approximate total completions")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="e.g. daily=0.6,weekly=0.3,monthly=0.1")
+    parser.add_argument("--samples", type=int, default=100, help="calls per timed function")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reuse", action="store_true", help="benchmark an existing database instead of generating")
+    parser.add_argument("--baseline", help="JSON from an earlier run to compare against")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    arguments = parser.parse_args()
+    instrumentation.install_from_environment()
+
+    if not arguments.reuse:
+        generate_database(arguments.database, arguments.habits, arguments.completions, arguments.mix,
+                          seed=arguments.seed)
+    report = run_benchmarks(arguments.database, arguments.samples, arguments.seed)
+    if arguments.baseline:
+        with open(arguments.baseline, encoding="utf-8") as baseline_file:
+            report["comparison"] = compare(report, json.load(baseline_file))
+
+    text = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
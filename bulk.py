@@ -0,0 +1,269 @@
+import argparse
+import csv
+import json
+import sqlite3
+import sys
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+import instrumentation
+from database import DEFAULT_USER_ID, create_table, get_user_connection
+from database_api import _FOLD_ASCII, _chunks, clear_habit_cache, get_timezone
+from periods import to_wall_clock
+
+# Rows inserted per executemany() and per transaction.
+CHUNK_SIZE = 10_000
+
+HABIT_FIELDS = ["name", "description", "priority", "periodicity", "created_at"]
+# Transaction control in a dump is skipped, the import commits in chunks of its own.
+TRANSACTION_STATEMENTS = ("BEGIN", "COMMIT", "END", "ROLLBACK")
+CSV_FIELDS = ["type", "name", "description", "priority", "periodicity", "created_at", "completed_at"]
+
+
+def _read_csv(source):
+    for row in csv.DictReader(source):
+        yield {field: value for field, value in row.items() if value != ""}
+
+
+def _read_jsonl(source):
+    for line in source:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _read_sql(source):
+    """
+    Yields the statements of an SQL dump one at a time, as raw strings.
+    """
+    statement = ""
+    for line in source:
+        statement += line
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ""
+    if statement.strip():
+        yield statement
+
+
+READERS = {"csv": _read_csv, "jsonl": _read_jsonl, "sql": _read_sql}
+
+
+def detect_format(path) -> str:
+    """
+    Guesses the file format from its extension.
+    """
+    extension = path.rsplit(".", 1)[-1].lower()
+    if extension not in READERS:
+        raise ValueError(f"Unknown format '{extension}', expected one of: {', '.join(READERS)}")
+    return extension
+
+
+def _checked_days(cursor, completions):
+    """
+    The (habit id, completed_date) pairs of completions that are already in the database.
+    """
+    days = [completed_at[:10] for _, completed_at, _, _ in completions]
+    checked_days = set()
+    for ids in _chunks({habit_id for habit_id, *_ in completions}):
+        cursor.execute(f"""
+            SELECT DISTINCT habit_id, completed_date FROM completions
+            WHERE habit_id IN ({", ".join("?" * len(ids))})
+                AND completed_date BETWEEN ? AND ?
+            """, (*ids, min(days), max(days)))
+        checked_days.update(cursor)
+    return checked_days
+
+
+def _import_records(connection, records, chunk_size, progress, user_id):
+    """
+    Inserts habit and completion records for the user in chunks, one transaction per chunk.
+    Completions reference their habit by name in any case; habits the user already has are skipped, and so are
+    completions on a day their habit is already checked off, so importing a file twice changes nothing.
+    completed_at with a UTC offset is converted to the user's timezone, without one it already is their time.
+    """
+    cursor = connection.cursor()
+    zone_name = get_timezone(user_id)
+    habit_ids = {name.translate(_FOLD_ASCII): habit_id for name, habit_id in
+                 cursor.execute("SELECT name, id FROM habits WHERE user_id = ?", (user_id,))}
+    counts = {"habits": 0, "completions": 0, "skipped": 0}
+
+    while True:
+        chunk = list(islice(records, chunk_size))
+        if not chunk:
+            break
+        completions = []
+        for record in chunk:
+            key = record["name"].translate(_FOLD_ASCII)
+            if record.get("type", "completion" if "completed_at" in record else "habit") == "habit":
+                if key in habit_ids:
+                    counts["skipped"] += 1
+                    continue
+                cursor.execute(
+                    "INSERT INTO habits (name, description, priority, periodicity, created_at, user_id) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [*(record[field] for field in HABIT_FIELDS), user_id])
+                habit_ids[key] = cursor.lastrowid
+                counts["habits"] += 1
+            elif key in habit_ids:
+                completed, offset = to_wall_clock(zone_name, datetime.fromisoformat(record["completed_at"]))
+                completions.append((habit_ids[key], completed.isoformat(), offset, user_id))
+            else:
+                counts["skipped"] += 1
+
+        checked_days = _checked_days(cursor, completions) if completions else set()
+        new_completions = []
+        for completion in completions:
+            day = (completion[0], completion[1][:10])
+            if day not in checked_days:
+                checked_days.add(day)
+                new_completions.append(completion)
+        counts["skipped"] += len(completions) - len(new_completions)
+        cursor.executemany("INSERT INTO completions (habit_id, completed_at, utc_offset, user_id) VALUES (?, ?, ?, ?)",
+                           new_completions)
+        counts["completions"] += len(new_completions)
+        connection.commit()
+        progress(counts)
+    return counts
+
+
+def _import_sql(connection, statements, chunk_size, progress, user_id):
+    """
+    Runs the statements of an SQL dump, committing every chunk_size statements.
+    Temporary triggers give every inserted habit and completion to the user, whatever user_id the dump has,
+    and abort the chunk when a completion refers to a habit the user does not own, e.g. because the dump's
+    habit ids are taken by other habits of a non-empty database.
+    """
+    cursor = connection.cursor()
+    for table in ["habits", "completions"]:
+        cursor.execute(f"""
+            CREATE TEMP TRIGGER IF NOT EXISTS import_{table}_owner AFTER INSERT ON main.{table}
+            BEGIN
+                UPDATE {table} SET user_id = {int(user_id)} WHERE id = NEW.id;
+            END
+            """)
+    cursor.execute(f"""
+        CREATE TEMP TRIGGER IF NOT EXISTS import_completions_habit BEFORE INSERT ON main.completions
+        WHEN NEW.habit_id NOT IN (SELECT id FROM main.habits WHERE user_id = {int(user_id)})
+        BEGIN
+            SELECT RAISE(ABORT, 'completion of a habit the importing user does not own');
+        END
+        """)
+    counts = {"statements": 0}
+    try:
+        while True:
+            chunk = list(islice(statements, chunk_size))
+            if not chunk:
+                break
+            cursor.execute("BEGIN")
+            for statement in chunk:
+                if not statement.lstrip().upper().startswith(TRANSACTION_STATEMENTS):
+                    cursor.execute(statement)
+            connection.commit()
+            counts["statements"] += len(chunk)
+            progress(counts)
+    finally:
+        connection.rollback()
+        for trigger in ["import_habits_owner", "import_completions_owner", "import_completions_habit"]:
+            cursor.execute(f"DROP TRIGGER IF EXISTS temp.{trigger}")
+    return counts
+
+
+def import_file(path, file_format=None, chunk_size=CHUNK_SIZE, progress=lambda counts: None,
+                user_id=DEFAULT_USER_ID):
+    """
+    Streams habits and completions from a CSV, JSONL or SQL file into the user's database.
+    Memory use is bounded by chunk_size, not by the size of the file. If the import fails, the chunk in progress
+    is rolled back and earlier chunks stay imported.
+    """
+    file_format = file_format or detect_format(path)
+    create_table()
+    connection = get_user_connection(user_id)
+    try:
+        with open(path, newline="", encoding="utf-8") as source:
+            records = READERS[file_format](source)
+            if file_format == "sql":
+                return _import_sql(connection, records, chunk_size, progress, user_id)
+            return _import_records(connection, records, chunk_size, progress, user_id)
+    except Exception:
+        # chunks before the failing one stay committed, the failing one must not be committed by the next write
+        connection.rollback()
+        raise
+    finally:
+        clear_habit_cache()
+
+
+def iter_export_records(user_id=DEFAULT_USER_ID):
+    """
+    Streams every habit of the user, then every completion, as import-compatible records.
+    completed_at carries its UTC offset when it is known.
+    """
+    connection = get_user_connection(user_id)
+    habits = connection.execute(f"SELECT {', '.join(HABIT_FIELDS)} FROM habits WHERE user_id = ? ORDER BY id",
+                                (user_id,))
+    for fields in habits:
+        yield {"type": "habit", **dict(zip(HABIT_FIELDS, fields))}
+    completions = connection.execute("""
+        SELECT habits.name, completions.completed_at, completions.utc_offset
+        FROM habits
+        JOIN completions ON completions.habit_id = habits.id
+        WHERE habits.user_id = ?
+        ORDER BY habits.name COLLATE NOCASE, habits.id, completions.completed_epoch
+        """, (user_id,))
+    for name, completed_at, offset in completions:
+        if offset is not None:
+            completed_at = datetime.fromisoformat(completed_at).replace(
+                tzinfo=timezone(timedelta(seconds=offset))).isoformat()
+        yield {"type": "completion", "name": name, "completed_at": completed_at}
+
+
+def export_file(target, file_format="jsonl", progress=lambda count: None, progress_every=CHUNK_SIZE,
+                user_id=DEFAULT_USER_ID):
+    """
+    Writes all habits and completions of the user to an open text file as CSV or JSONL.
+    Returns the number of records written.
+    """
+    if file_format == "csv":
+        writer = csv.DictWriter(target, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+    elif file_format == "jsonl":
+        write = lambda record: target.write(json.dumps(record) + "\n")
+    else:
+        raise ValueError(f"Cannot export to '{file_format}', expected csv or jsonl")
+
+    count = 0
+    for count, record in enumerate(iter_export_records(user_id), start=1):
+        write(record)
+        if count % progress_every == 0:
+            progress(count)
+    progress(count)
+    return count
+
+
+def _print_progress(counts):
+    print(f"\r{counts}", end="", file=sys.stderr, flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk import or export habits and completions.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="load a CSV, JSONL or SQL file")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--format", choices=list(READERS), help="default: from the file extension")
+    import_parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    import_parser.add_argument("--user", type=int, default=DEFAULT_USER_ID, help="owner of the imported data")
+    export_parser = commands.add_parser("export", help="write all data as CSV or JSONL")
+    export_parser.add_argument("path", help="output file, '-' for stdout")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"], default="jsonl")
+    export_parser.add_argument("--user", type=int, default=DEFAULT_USER_ID, help="whose data to export")
+    arguments = parser.parse_args()
+    instrumentation.install_from_environment()
+
+    if arguments.command == "import":
+        result = import_file(arguments.path, arguments.format, arguments.chunk_size, _print_progress, arguments.user)
+    elif arguments.path == "-":
+        result = export_file(sys.stdout, arguments.format, _print_progress, user_id=arguments.user)
+    else:
+        with open(arguments.path, "w", newline="", encoding="utf-8") as output:
+            result = export_file(output, arguments.format, _print_progress, user_id=arguments.user)
+    print(f"\nDone: {result}", file=sys.stderr)
@@ -1,5 +1,7 @@
+import sys
 from typing import *
 from analytics import *
+import instrumentation
 
 
 def press_enter(msg: str = "Press enter to continue..."):
@@ -54,12 +56,18 @@ def list_habits_logic():
     """
     List all Habits
     """
-    habits = get_all_habits()
-    if not habits:
+    habit = None
+    for habit in cached_read(get_all_habits):
+        print(habit)
+    if habit is None:
         print("No habits found.")
-    else:
-        for habit in habits:
-            print(habit)
+
+
+def habits_checked_today() -> List[Habit]:
+    """
+    Habits checked off today in the user's timezone; reads and releases the connection before any prompt.
+    """
+    return cached_read(get_habits_completed_in, "daily", user_now(DEFAULT_USER_ID).date())
 
 
 def check_off_logic():
@@ -67,28 +75,16 @@ def check_off_logic():
     Check Habit Off by ID or Name
     """
     print("Habits already checked today:")
+    habits = habits_checked_today()
+    if not habits:
+        print("(No habits checked today)")
+    else:
+        for habit in habits:
+            print(f"  - {habit.name}")
 
-    today = datetime.now().date().isoformat()
-    with create_connection() as connection:
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT DISTINCT habits.name
-            FROM completions
-            JOIN habits ON habits.id = completions.habit_id
-            WHERE substr(completions.completed_at, 1, 10) = ?
-            ORDER BY habits.name
-        """, (today,))
-        rows = cursor.fetchall()
-
-        if not rows:
-            print("(No habits checked today)")
-        else:
-            for (name,) in rows:
-                print(f"  - {name}")
-
-        list_habits_logic()
-        habit_name = input("Enter Habit Name to check off: ").strip()
-        check_off_habit(habit_name)
+    list_habits_logic()
+    habit_name = input("Enter Habit Name to check off: ").strip()
+    check_off_habit(habit_name)
 
 
 def show_all_checked_off_logic():
@@ -96,23 +92,13 @@ def show_all_checked_off_logic():
     Show all Habits that were checked off today
     """
     print("All habits checked today:")
-    today = datetime.now().date().isoformat()
-
-    with create_connection() as connection:
-        cursor = connection.cursor()
-        cursor.execute("""SELECT DISTINCT habits.name
-                       FROM completions
-                       JOIN habits ON habits.id = completions.habit_id
-                       WHERE substr(completions.completed_at, 1,10) = ?
-                       ORDER BY habits.name
-                       """, (today,))
-        rows = cursor.fetchall()
-        if not rows:
-            print("(No habits checked today)")
-        else:
-            for (name, ) in rows:
-                name = name.strip().title()
-                print(f"  - {name}")
+    habits = habits_checked_today()
+    if not habits:
+        print("(No habits checked today)")
+    else:
+        for habit in habits:
+            name = habit.name.strip().title()
+            print(f"  - {name}")
 
 
 def remove_habit_logic():
@@ -127,30 +113,28 @@ def analytics_logic():
     """
     Return the longest streaks for each habit and one longest streak
     """
-    habits = get_all_habits()
-    if not habits:
+    streaks = cached_streaks()
+    if not streaks:
         print("No habits found.")
     else:
         print("Habit Streaks:")
-        for habit in habits:
-            streak = longest_streak(habit)
+        for habit, streak, _ in streaks:
             unit = "day" if habit.periodicity == "daily" else ("week" if habit.periodicity == "weekly" else "month")
             plural = "" if streak == 1 else "s"
             print(f"  - {habit.name}: {streak} {unit}{plural} streak")
-        print(f"Longest Overall Streak: {max_overall_streak()}")
+        print(f"Longest Overall Streak: {max(streak for _, streak, _ in streaks)}")
 
 
 def current_streaks_logic():
     """
     Return the current streaks for each Habit
     """
-    habits = get_all_habits()
-    if not habits:
+    streaks = cached_streaks()
+    if not streaks:
         print("No habits found.")
         return
     print("Current Streaks:")
-    for habit in habits:
-        streak = current_streak(habit)
+    for habit, _, streak in streaks:
         unit = "day" if habit.periodicity == "daily" else ("week" if habit.periodicity == "weekly" else "month")
         plural = "" if streak == 1 else "s"
         print(f"  - {habit.name}: {streak} {unit}{plural} current")
@@ -167,7 +151,7 @@ def show_habits_by_periodicity_logic():
         print("Invalid periodicity")
         return
 
-    names = habits_by_periodicity(periodicity)
+    names = cached_read(habits_by_periodicity, periodicity)
     if not names:
         print(f"No {periodicity} habits found.")
     else:
@@ -209,6 +193,10 @@ def run_cli():
 
 
 if __name__ == "__main__":
+    # --profile (or --profile=json) prints call counts and timings on exit, like HABITS_PROFILE does
+    profile_flags = [argument for argument in sys.argv[1:] if argument.startswith("--profile")]
+    instrumentation.install_from_environment(
+        profile_flags[-1].partition("=")[2] or "text" if profile_flags else None)
     try:
         run_cli()
         # exiting the console with ctrl+c posts this note :)
@@ -1,37 +1,225 @@
+import atexit
+import contextlib
+import itertools
+import os
 import sqlite3
+import threading
 
 DATABASE = 'habits.db'
 
+# Owner of habits when no user is given, e.g. in the single-person CLI.
+DEFAULT_USER_ID = 1
+
+# IANA timezone of users who have not set one; None is the server's local zone.
+DEFAULT_TIMEZONE = None
+
+# When set, every user gets an own database file in this directory instead of sharing DATABASE.
+SHARD_DIRECTORY = None
+
+# PRAGMAs applied to every pooled connection when it is opened.
+# Change them (or call configure()) before the first query of the process.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 64 * 1024 * 1024,
+    "cache_size": -8000,
+}
+
+_local = threading.local()
+_serials = itertools.count(1)
+_open_connections = []
+_open_connections_lock = threading.Lock()
+_migrated_shards = set()
+
+
+def configure(**pragmas):
+    """
+    Overrides PRAGMA values for connections opened from now on.
+    A value of None removes the PRAGMA.
+    """
+    for pragma, value in pragmas.items():
+        if value is None:
+            PRAGMAS.pop(pragma, None)
+        else:
+            PRAGMAS[pragma] = value
+
+
+class _PooledConnection(sqlite3.Connection):
+    """
+    A connection with a serial number unique in the process, so state tied to one connection, such as its
+    PRAGMA data_version, is never mistaken for that of a connection opened later.
+    """
+
+    def __init__(self, *arguments, **keywords):
+        super().__init__(*arguments, **keywords)
+        self.serial = next(_serials)
+
+
+def _open_connection(path):
+    """
+    Opens a new connection and applies the configured PRAGMAs.
+    """
+    connection = sqlite3.connect(path, check_same_thread=False, factory=_PooledConnection)
+    for pragma, value in PRAGMAS.items():
+        connection.execute(f"PRAGMA {pragma} = {value}")
+    with _open_connections_lock:
+        _open_connections.append(connection)
+    return connection
+
+
+def use_database(path):
+    """
+    Makes path the default database of the calling thread, e.g. for a worker thread serving another file.
+    """
+    _local.default_path = path
+
+
+def _default_path():
+    return getattr(_local, "default_path", None) or DATABASE
+
+
+def _thread_connections():
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    return connections
+
+
+def get_connection(path=None):
+    """
+    Returns the long-lived connection of the calling thread, opening it on first use.
+    Use it as a context manager to commit (or roll back) a transaction; it is never closed there.
+    """
+    path = path or _default_path()
+    connections = _thread_connections()
+    connection = connections.get(path)
+    if connection is None:
+        connection = connections[path] = _open_connection(path)
+    return connection
+
+
+def database_for_user(user_id=DEFAULT_USER_ID):
+    """
+    Routes a user to their database file: the shared database, or their own shard in SHARD_DIRECTORY.
+    Shards are created and migrated on first use.
+    """
+    if SHARD_DIRECTORY is None:
+        return None
+    path = os.path.join(SHARD_DIRECTORY, f"user_{int(user_id)}.db")
+    if path not in _migrated_shards:
+        from migrations import migrate  # migrations imports this module
+
+        os.makedirs(SHARD_DIRECTORY, exist_ok=True)
+        migrate(path)
+        _migrated_shards.add(path)
+    return path
+
+
+def database_path(user_id=DEFAULT_USER_ID):
+    """
+    Returns the path of the database holding user_id's data for the calling thread.
+    """
+    return database_for_user(user_id) or _default_path()
+
+
+def get_user_connection(user_id=DEFAULT_USER_ID):
+    """
+    Returns the calling thread's connection to the database holding user_id's data.
+    """
+    return get_connection(database_path(user_id))
+
+
+def open_read_only(path):
+    """
+    Opens a separate, unpooled read-only connection, e.g. for a worker process. The caller closes it.
+    """
+    connection = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    for pragma in ["mmap_size", "cache_size"]:
+        if pragma in PRAGMAS:
+            connection.execute(f"PRAGMA {pragma} = {PRAGMAS[pragma]}")
+    return connection
+
+
+@contextlib.contextmanager
+def snapshot(path=None, target=":memory:"):
+    """
+    Copies the database with SQLite's online backup into memory (or into a replica file at target) and
+    makes the copy the calling thread's connection for path until the block ends.
+    Everything read in the block sees one consistent state, other threads and processes keep writing
+    to the file, and writes made in the block, such as cached streak states, only change the copy.
+    """
+    path = path or _default_path()
+    copy = sqlite3.connect(target, check_same_thread=False, factory=_PooledConnection)
+    get_connection(path).backup(copy)
+    connections = _thread_connections()
+    previous = connections.get(path)
+    connections[path] = copy
+    snapshots = getattr(_local, "snapshots", None)
+    if snapshots is None:
+        snapshots = _local.snapshots = set()
+    snapshots.add(path)
+    try:
+        yield copy
+    finally:
+        snapshots.discard(path)
+        if previous is None:
+            connections.pop(path, None)
+        else:
+            connections[path] = previous
+        copy.close()
+
+
+def in_snapshot(path=None) -> bool:
+    """
+    Tells whether the calling thread reads path from a snapshot() copy.
+    """
+    return (path or _default_path()) in getattr(_local, "snapshots", ())
+
 
 def create_connection():
     """
     Connects to the database.
+    Kept for existing callers, it hands out the pooled connection of the calling thread.
+    """
+    return get_connection()
+
+
+def close_connection(path=None):
+    """
+    Closes the calling thread's connection to the database.
     """
-    return sqlite3.connect(DATABASE)
+    path = path or _default_path()
+    connections = getattr(_local, "connections", {})
+    connection = connections.pop(path, None)
+    if connection is not None:
+        with _open_connections_lock:
+            if connection in _open_connections:
+                _open_connections.remove(connection)
+        connection.close()
+
+
+def close_all_connections():
+    """
+    Closes every pooled connection of every thread, used on shutdown.
+    """
+    with _open_connections_lock:
+        connections = list(_open_connections)
+        _open_connections.clear()
+    for connection in connections:
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+    _local.__dict__.clear()
+
+
+atexit.register(close_all_connections)
 
 
 def create_table():
     """
-    Creates a table in the database, unless it already exists.
-    """
-    with create_connection() as connection:
-        cursor = connection.cursor()
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS habits (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE NOT NULL,
-            description TEXT NOT NULL,
-            priority INTEGER NOT NULL,
-            periodicity TEXT CHECK(periodicity IN ('daily', 'weekly', 'monthly')) NOT NULL,
-            created_at TEXT NOT NULL
-        );
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS completions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            habit_id INTEGER NOT NULL,
-            completed_at TEXT NOT NULL,
-            FOREIGN KEY (habit_id) REFERENCES habits (id)
-        );
-        """)
-        connection.commit()
+    Creates the tables in the database, or upgrades them to the latest schema version.
+    """
+    from migrations import migrate  # migrations imports this module
+
+    migrate()
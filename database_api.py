@@ -1,6 +1,12 @@
-from datetime import datetime
+import string
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from itertools import groupby
+from operator import itemgetter
 from database import *
-from habit import Habit
+from habit import Habit, habit_row_factory
+from periods import epoch_seconds, period_bounds, period_key_function, to_wall_clock, wall_clock_now
 
 
 def prompt_priority() -> int:
@@ -20,162 +26,793 @@ def prompt_periodicity() -> str:
         print("Invalid periodicity. Choose: daily, weekly, or monthly.")
 
 
-def create_habit(name, description, priority, periodicity):
+HABIT_COLUMNS = "id, name, description, priority, periodicity, created_at, user_id"
+
+# Habit names compare like SQLite's NOCASE collation, which only folds ASCII letters.
+_FOLD_ASCII = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+HABIT_CACHE_SIZE = 4_096
+TIMEZONE_CACHE_SIZE = 1_024
+RESULT_CACHE_SIZE = 1_024
+
+_MISSING = object()
+
+
+class _VersionedCache:
     """
-    Creates a new habit.
+    A thread-safe LRU map of key -> (data_version() when cached, value) holding at most size entries.
+    A lookup at another data version misses and drops the entry.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] != version:
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, value):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# (database path, user id, habit id or folded name) -> Habit
+_habit_cache = _VersionedCache(HABIT_CACHE_SIZE)
+
+# (database path, user id) -> IANA timezone name of the user
+_timezone_cache = _VersionedCache(TIMEZONE_CACHE_SIZE)
+
+# (function, arguments, keyword arguments, database path, user id) -> result of cached_read()
+_results = _VersionedCache(RESULT_CACHE_SIZE)
+
+# (database path, user id) -> writes made through this module to the user's data; see data_version().
+_write_counts = {}
+# Bumped by clear_habit_cache(), so results computed while clearing are not kept.
+_generation = 0
+_versions_lock = threading.Lock()
+
+# SQLite's default limit of bound parameters per statement is 999 before 3.32.
+SQL_VARIABLES_PER_QUERY = 500
+
+# Rows per fetchmany() when streaming completions: large enough to amortise the calls into SQLite,
+# small enough that memory does not grow with a habit's history.
+FETCH_SIZE = 1_000
+
+# Kept as one constant so every call reuses the statement sqlite3 compiled and cached for the connection.
+# A half-open range of day ordinals is served by idx_completions_user_day_habit without reading the table.
+HABITS_COMPLETED_BETWEEN_SQL = f"""
+    SELECT {HABIT_COLUMNS} FROM habits
+    WHERE user_id = ?
+        AND id IN (SELECT habit_id FROM completions WHERE user_id = ? AND completed_day >= ? AND completed_day < ?)
+    ORDER BY name
+    """
+
+# Outcomes of check_off_events() and check_off_habits(), one per event.
+CHECKED = "checked"
+ALREADY_CHECKED = "already checked"
+NOT_FOUND = "not found"
+
+
+def _cache_key(user_id, identifier):
+    if isinstance(identifier, int):
+        return database_path(user_id), user_id, identifier
+    return database_path(user_id), user_id, identifier.strip().translate(_FOLD_ASCII)
+
+
+def _cached_habit(user_id, identifier, version) -> Habit | None:
+    """
+    The cached habit, unless it was cached at another data_version(), e.g. before another process changed it.
+    """
+    return _habit_cache.get(_cache_key(user_id, identifier), version)
+
+
+def _cache_habit(habit, version):
+    _habit_cache.put(_cache_key(habit.user_id, habit.id), version, habit)
+    _habit_cache.put(_cache_key(habit.user_id, habit.name), version, habit)
+
+
+def _bump_data_version(user_id=DEFAULT_USER_ID):
+    key = (database_path(user_id), user_id)
+    with _versions_lock:
+        _write_counts[key] = _write_counts.get(key, 0) + 1
+
+
+def clear_habit_cache():
+    """
+    Forgets every cached habit, timezone and cached_read() result.
+    Call it after changing habits, completions or user settings without this module, e.g. in SQL.
+    """
+    global _generation
+    with _versions_lock:
+        _generation += 1
+    _habit_cache.clear()
+    _timezone_cache.clear()
+    _results.clear()
+
+
+def data_version(user_id=DEFAULT_USER_ID) -> tuple:
+    """
+    Changes whenever data the user reads may have changed: with every create, update, remove and check-off of
+    the user made through this module, and with every commit another connection makes to the user's database file.
+    PRAGMA data_version only counts for the connection that reads it, so the calling thread's connection is part
+    of the version: values cached through one connection are not trusted by another.
+    """
+    path = database_path(user_id)
+    connection = get_connection(path)
+    return (_generation, _write_counts.get((path, user_id), 0), connection.serial,
+            connection.execute("PRAGMA data_version").fetchone()[0])
+
+
+def cached_read(function, *arguments, user_id=DEFAULT_USER_ID, **keywords):
+    """
+    Returns function(*arguments, user_id=user_id, **keywords), reusing the previous result while data_version() is unchanged.
+    data_version() includes the calling thread's connection, so a result is only reused through the connection
+    that read it. At most RESULT_CACHE_SIZE results are kept. Results are shared between callers, do not modify them.
+    Reads inside snapshot() are not cached.
+    """
+    path = database_path(user_id)
+    if in_snapshot(path):
+        return function(*arguments, user_id=user_id, **keywords)
+    key = (function, arguments, tuple(sorted(keywords.items())), path, user_id)
+    version = data_version(user_id)
+    result = _results.get(key, version, _MISSING)
+    if result is _MISSING:
+        result = function(*arguments, user_id=user_id, **keywords)
+        _results.put(key, version, result)
+    return result
+
+
+def get_timezone(user_id=DEFAULT_USER_ID) -> str | None:
+    """
+    Returns the user's IANA timezone name, or DEFAULT_TIMEZONE when they have not set one.
+    """
+    key = (database_path(user_id), user_id)
+    version = data_version(user_id)
+    zone_name = _timezone_cache.get(key, version, _MISSING)
+    if zone_name is _MISSING:
+        row = get_user_connection(user_id).execute(
+            "SELECT timezone FROM user_settings WHERE user_id = ?", (user_id,)).fetchone()
+        zone_name = row[0] if row else DEFAULT_TIMEZONE
+        _timezone_cache.put(key, version, zone_name)
+    return zone_name
+
+
+def set_timezone(zone_name, user_id=DEFAULT_USER_ID):
+    """
+    Sets the user's IANA timezone, e.g. "Europe/Berlin", which decides their "today" and the day, week and month
+    of their check-offs from now on. Raises ValueError for an unknown zone.
+    """
+    try:
+        wall_clock_now(zone_name)
+    except (ValueError, LookupError) as error:  # ZoneInfoNotFoundError is a KeyError
+        raise ValueError(f"Unknown timezone '{zone_name}'.") from error
+    with get_user_connection(user_id) as connection:
+        connection.execute("INSERT OR REPLACE INTO user_settings (user_id, timezone) VALUES (?, ?)",
+                           (user_id, zone_name))
+    _bump_data_version(user_id)
+    _timezone_cache.put((database_path(user_id), user_id), data_version(user_id), zone_name)
+
+
+def user_now(user_id=DEFAULT_USER_ID) -> datetime:
     """
-    with create_connection() as connection:
+    Returns the current wall-clock time in the user's timezone, as a naive datetime like the stored ones.
+    """
+    return wall_clock_now(get_timezone(user_id))
+
+
+def add_habit(name, description, priority, periodicity, user_id=DEFAULT_USER_ID) -> Habit | None:
+    """
+    Inserts a new habit and returns it, or None if the user already has a habit with that name in any case.
+    """
+    if _find_habit_by_name(name, user_id) is not None:
+        return None
+    with get_user_connection(user_id) as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT * FROM habits WHERE name = ?", (name,))
-        if cursor.fetchone():
-            print(f"Habit '{name}' already exists.")
-            return
+        created_at = user_now(user_id).replace(microsecond=0).isoformat()
         cursor.execute(
-            "INSERT INTO habits (name, description, priority, periodicity, created_at) VALUES (?, ?, ?, ?, ?)",
-            (name, description, priority, periodicity, datetime.now().replace(microsecond=0).isoformat()))
+            "INSERT INTO habits (name, description, priority, periodicity, created_at, user_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (name, description, priority, periodicity, created_at, user_id))
         connection.commit()
-        print(f"Habit '{name}' created successfully.")
+        _bump_data_version(user_id)
+        return Habit(id=cursor.lastrowid, name=name, description=description, priority=priority,
+                     periodicity=periodicity, created_at=created_at, user_id=user_id)
+
 
+def create_habit(name, description, priority, periodicity, user_id=DEFAULT_USER_ID):
+    """
+    Creates a new habit.
+    """
+    if add_habit(name, description, priority, periodicity, user_id) is None:
+        print(f"Habit '{name}' already exists.")
+        return
+    print(f"Habit '{name}' created successfully.")
 
-def get_habit(identifier) -> Habit | None:
+
+def _find_habit_by_name(name, user_id=DEFAULT_USER_ID) -> Habit | None:
     """
-    Look up a habit by ID (int or digit-string) or by name (string in lowercase).
-    Returns a Habit instance.
+    Looks up one of the user's habits by name only, in any case, so a name made of digits is never taken for an id.
     """
-    with create_connection() as connection:
-        cursor = connection.cursor()
+    version = data_version(user_id)
+    habit = _cached_habit(user_id, name, version)
+    if habit is not None:
+        return habit
+    cursor = get_user_connection(user_id).cursor()
+    cursor.row_factory = habit_row_factory
+    cursor.execute(f"SELECT {HABIT_COLUMNS} FROM habits WHERE user_id = ? AND name = ? COLLATE NOCASE",
+                   (user_id, name.strip()))
+    habit = cursor.fetchone()
+    if habit:
+        _cache_habit(habit, version)
+    return habit
+
+
+def get_habit(identifier, user_id=DEFAULT_USER_ID) -> Habit | None:
+    """
+    Look up one of the user's habits by ID (int or digit-string) or by name (in any case).
+    Returns a Habit instance. Found habits are cached until data_version() changes, so repeated lookups only
+    read PRAGMA data_version instead of the habits table.
+    """
+    if isinstance(identifier, str) and identifier.strip().isdigit():
+        identifier = int(identifier)
+    # Search by name (any case) if a string is written in CLI
+    if not isinstance(identifier, int):
+        return _find_habit_by_name(identifier, user_id)
+
+    # Search by ID in case a number ID is written in CLI
+    version = data_version(user_id)
+    habit = _cached_habit(user_id, identifier, version)
+    if habit is not None:
+        return habit
+    cursor = get_user_connection(user_id).cursor()
+    cursor.row_factory = habit_row_factory
+    cursor.execute(f"SELECT {HABIT_COLUMNS} FROM habits WHERE id = ? AND user_id = ?", (identifier, user_id))
+    habit = cursor.fetchone()
+    if habit:
+        _cache_habit(habit, version)
+    return habit
+
+
+def update_habit(name, user_id=DEFAULT_USER_ID):
+    habit = _find_habit_by_name(name, user_id)
+    if habit is None:
+        print(f"Habit '{name}' not found.")
+        return
+    print(f"Would you like to update the habit '{habit.name}'? (y/n)")
+    if input().strip().lower() != "y":
+        print("No changes made.")
+        return
+    new_name = input("Enter new habit name: ")
+    new_description = input("Enter new habit description: ")
+    new_priority = prompt_priority()
+    new_periodicity = prompt_periodicity()
 
-        # Search by ID in case a number ID is written in CLI
-        if isinstance(identifier, int) or (isinstance(identifier, str) and identifier.strip().isdigit()):
-            cursor.execute("SELECT * FROM habits WHERE id = ?", (int(identifier),))
-            row = cursor.fetchone()
-            return Habit(id=row[0], name=row[1], description=row[2], priority=row[3], periodicity=row[4],
-                         created_at=row[5]) if row else None
+    with get_user_connection(user_id) as connection:
+        _update_habit_row(connection.cursor(), habit.id, habit.periodicity,
+                          new_name, new_description, new_priority, new_periodicity)
+    _bump_data_version(user_id)
+    print(f"Habit '{habit.name}' changed successfully.")
 
-        # Search by name (lowercase) if a string is written in CLI
-        key = identifier.strip()
-        cursor.execute("SELECT * FROM habits WHERE lower(name) = lower(?)", (key,))
-        row = cursor.fetchone()
-        if row:
-            return Habit(id=row[0], name=row[1], description=row[2], priority=row[3], periodicity=row[4],
-                         created_at=row[5])
 
+def _update_habit_row(cursor, habit_id, old_periodicity, name, description, priority, periodicity):
+    # leaves original "created_at"
+    cursor.execute(
+        "UPDATE habits SET name = ?, description = ?, priority = ?, periodicity = ? WHERE id = ?",
+        (name, description, priority, periodicity, habit_id)
+    )
+    if periodicity != old_periodicity:
+        cursor.execute("DELETE FROM streak_state WHERE habit_id = ?", (habit_id,))
 
-def update_habit(name):
-    with create_connection() as connection:
+
+def edit_habit(identifier, name=None, description=None, priority=None, periodicity=None,
+               user_id=DEFAULT_USER_ID) -> Habit | None:
+    """
+    Changes the given fields of one of the user's habits, found by ID or name.
+    Returns the updated habit, or None if it does not exist.
+    """
+    habit = get_habit(identifier, user_id)
+    if habit is None:
+        return None
+    with get_user_connection(user_id) as connection:
+        _update_habit_row(connection.cursor(), habit.id, habit.periodicity,
+                          habit.name if name is None else name,
+                          habit.description if description is None else description,
+                          habit.priority if priority is None else priority,
+                          habit.periodicity if periodicity is None else periodicity)
+    _bump_data_version(user_id)
+    return get_habit(habit.id, user_id)
+
+
+def delete_habit(name, user_id=DEFAULT_USER_ID) -> bool:
+    """
+    Deletes one of the user's habits and its completions. Returns False if it does not exist.
+    """
+    habit = _find_habit_by_name(name, user_id)
+    if habit is None:
+        return False
+    with get_user_connection(user_id) as connection:
         cursor = connection.cursor()
-        cursor.execute(
-            "SELECT id, name, description, priority, periodicity, created_at FROM habits WHERE lower(name) = lower(?)",
-            (name,)
-        )
-        row = cursor.fetchone()
-        if row is None:
-            print(f"Habit '{name}' not found.")
-            return
-        habit_id, old_name, old_description, old_priority, old_periodicity, created_at = row
-
-        print(f"Would you like to update the habit '{old_name}'? (y/n)")
-        if input().strip().lower() != "y":
-            print("No changes made.")
-            return
-        new_name = input("Enter new habit name: ")
-        new_description = input("Enter new habit description: ")
-        new_priority = prompt_priority()
-        new_periodicity = prompt_periodicity()
-
-        # leaves original "created_at"
-        cursor.execute(
-            "UPDATE habits SET name = ?, description = ?, priority = ?, periodicity = ? WHERE id = ?",
-            (new_name, new_description, new_priority, new_periodicity, habit_id)
-        )
+        cursor.execute("DELETE FROM completions WHERE habit_id = ?", (habit.id,))
+        cursor.execute("DELETE FROM streak_state WHERE habit_id = ?", (habit.id,))
+        cursor.execute("DELETE FROM habits WHERE id = ?", (habit.id,))
         connection.commit()
-        print(f"Habit '{old_name}' changed successfully.")
+    _bump_data_version(user_id)
+    return True
 
 
-def remove_habit(name):
+def remove_habit(name, user_id=DEFAULT_USER_ID):
     """
     Removes a habit, no warning.
     """
-    with create_connection() as connection:
+    if not delete_habit(name, user_id):
+        print(f"Habit '{name}' not found.")
+        return
+    print(f"Habit '{name}' and its completions removed.")
+
+
+def iter_habits(user_id=DEFAULT_USER_ID, periodicity=None):
+    """
+    Streams the user's habits in id order, optionally only those of one periodicity,
+    without holding them all in memory.
+    """
+    cursor = get_user_connection(user_id).cursor()
+    cursor.row_factory = habit_row_factory
+    if periodicity is None:
+        cursor.execute(f"SELECT {HABIT_COLUMNS} FROM habits WHERE user_id = ? ORDER BY id", (user_id,))
+    else:
+        cursor.execute(f"SELECT {HABIT_COLUMNS} FROM habits WHERE user_id = ? AND periodicity = ? ORDER BY id",
+                       (user_id, periodicity))
+    yield from cursor
+
+
+def get_habits_by_periodicity(periodicity, user_id=DEFAULT_USER_ID) -> list[Habit]:
+    """
+    Returns a list of the user's habits by periodicity.
+    """
+    return list(iter_habits(user_id, periodicity))
+
+
+def get_all_habits(user_id=DEFAULT_USER_ID) -> list[Habit]:
+    """
+    Returns a list of all habits of the user.
+    """
+    return list(iter_habits(user_id))
+
+
+def get_habits_completed_between(first_date, end_date, user_id=DEFAULT_USER_ID) -> list[Habit]:
+    """
+    Returns the user's habits with a completion on a day from first_date up to, not including, end_date,
+    sorted by name.
+    """
+    cursor = get_user_connection(user_id).cursor()
+    cursor.row_factory = habit_row_factory
+    cursor.execute(HABITS_COMPLETED_BETWEEN_SQL, (user_id, user_id, first_date.toordinal(), end_date.toordinal()))
+    return cursor.fetchall()
+
+
+def get_habits_completed_in(periodicity, day=None, user_id=DEFAULT_USER_ID) -> list[Habit]:
+    """
+    Returns the user's habits completed in the day, ISO week or month (periodicity "daily", "weekly" or "monthly")
+    containing day, by default today in the user's timezone, sorted by name.
+    """
+    first_day, end_day = period_bounds(periodicity, (day or user_now(user_id).date()).toordinal())
+    return get_habits_completed_between(date.fromordinal(first_day), date.fromordinal(end_day), user_id)
+
+
+def get_habits_checked_on(day, user_id=DEFAULT_USER_ID) -> list[Habit]:
+    """
+    Returns the user's habits with a completion on the given date, sorted by name.
+    """
+    return get_habits_completed_in("daily", day, user_id)
+
+
+def _chunks(values, size=SQL_VARIABLES_PER_QUERY):
+    values = list(values)
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+
+def check_off_events(events, user_id=DEFAULT_USER_ID) -> list:
+    """
+    Checks off many (habit name, completed at) events of the user in a single transaction.
+    completed at is a datetime or an ISO 8601 string; naive ones are wall-clock time in the user's timezone,
+    aware ones are converted to it. Like check_off_habit(), a habit counts once per day of the user:
+    events for a day that is already in the database, or earlier in the batch, are rejected.
+    Returns CHECKED, ALREADY_CHECKED or NOT_FOUND for each event, in order.
+    """
+    zone_name = get_timezone(user_id)
+    events = [(name, *to_wall_clock(zone_name, datetime.fromisoformat(completed) if isinstance(completed, str)
+                                    else completed)) for name, completed in events]
+    events = [(name, completed.replace(microsecond=0), offset) for name, completed, offset in events]
+    version = data_version(user_id)
+    with get_user_connection(user_id) as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT id FROM habits WHERE lower(name) = ?", (name.lower(),))
-        row = cursor.fetchone()
-        if row is None:
-            print(f"Habit '{name}' not found.")
-            return
-        habit_id = row[0]
-        cursor.execute("DELETE FROM completions WHERE habit_id = ?", (habit_id,))
-        cursor.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
+        habits_by_name, missing = {}, set()
+        for name, *_ in events:
+            key = name.strip().translate(_FOLD_ASCII)
+            habit = _cached_habit(user_id, key, version)
+            if habit is not None:
+                habits_by_name[key] = (habit.id, habit.periodicity)
+            else:
+                missing.add(key)
+        for names in _chunks(missing):
+            habits = connection.execute(f"""
+                SELECT {HABIT_COLUMNS} FROM habits
+                WHERE user_id = ? AND name COLLATE NOCASE IN ({", ".join("?" * len(names))})
+                """, (user_id, *names))
+            for habit in map(Habit._make, habits):
+                _cache_habit(habit, version)
+                habits_by_name[habit.name.translate(_FOLD_ASCII)] = (habit.id, habit.periodicity)
+
+        habit_ids = {habit_id for habit_id, _ in habits_by_name.values()}
+        days = [completed.date().isoformat() for _, completed, _ in events]
+        checked_days = set()
+        if habit_ids:
+            for ids in _chunks(habit_ids):
+                cursor.execute(f"""
+                    SELECT DISTINCT habit_id, completed_date FROM completions
+                    WHERE habit_id IN ({", ".join("?" * len(ids))})
+                        AND completed_date BETWEEN ? AND ?
+                    """, (*ids, min(days), max(days)))
+                checked_days.update(cursor)
+
+        statuses, completions = [], []
+        for (name, completed, offset), day in zip(events, days):
+            habit = habits_by_name.get(name.strip().translate(_FOLD_ASCII))
+            if habit is None:
+                statuses.append(NOT_FOUND)
+            elif (habit[0], day) in checked_days:
+                statuses.append(ALREADY_CHECKED)
+            else:
+                checked_days.add((habit[0], day))
+                completions.append((habit[0], habit[1], completed, offset))
+                statuses.append(CHECKED)
+        if not completions:
+            return statuses
+
+        states = {}
+        for ids in _chunks({habit_id for habit_id, *_ in completions}):
+            cursor.execute(f"""
+                SELECT habit_id, last_key, last_epoch, last_day, current_run, longest_run FROM streak_state
+                WHERE habit_id IN ({", ".join("?" * len(ids))})
+                """, ids)
+            states.update((row[0], row[1:]) for row in cursor)
+        cursor.executemany("INSERT INTO completions (habit_id, completed_at, utc_offset, user_id) VALUES (?, ?, ?, ?)",
+                           [(habit_id, completed.isoformat(), offset, user_id)
+                            for habit_id, _, completed, offset in completions])
+
+        # the insert trigger dropped these states, write back the ones the new completions extend in order
+        completions.sort(key=itemgetter(0, 2))
+        advanced = []
+        for habit_id, habit_completions in groupby(completions, key=itemgetter(0)):
+            state = states.get(habit_id)
+            for _, periodicity, completed, _ in habit_completions:
+                state = _next_streak_state(periodicity, state, completed)
+            if state is not None:
+                advanced.append((habit_id, *state))
+        cursor.executemany("""
+            INSERT OR REPLACE INTO streak_state (habit_id, last_key, last_epoch, last_day, current_run, longest_run)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, advanced)
         connection.commit()
-        print(f"Habit '{name}' and its completions removed.")
+        _bump_data_version(user_id)
+        return statuses
+
+
+def check_off_habits(names, user_id=DEFAULT_USER_ID) -> list:
+    """
+    Checks off several of the user's habits as done today in a single transaction.
+    Returns CHECKED, ALREADY_CHECKED or NOT_FOUND for each name, in order.
+    """
+    completed = datetime.now(timezone.utc)
+    return check_off_events([(name, completed) for name in names], user_id)
+
 
+def check_off_habit(name, user_id=DEFAULT_USER_ID):
+    """
+    Checks off a habit as done today.
+    """
+    status = check_off_habits([name], user_id)[0]
+    if status == NOT_FOUND:
+        print(f"Habit '{name}' not found.")
+    elif status == ALREADY_CHECKED:
+        print(f"Habit '{name}' already checked.")
+    else:
+        print(f"Habit '{name}' checked off.")
+
+
+def _fetch_batches(cursor, size=None):
+    """
+    Yields the rows of an executed cursor as lists of at most size (default FETCH_SIZE) rows.
+    """
+    cursor.arraysize = size or FETCH_SIZE
+    while rows := cursor.fetchmany():
+        yield rows
+
+
+def iter_completed_habits(name, user_id=DEFAULT_USER_ID):
+    """
+    Streams the completed_at timestamps of a habit in order, FETCH_SIZE rows at a time.
+    """
+    habit = _find_habit_by_name(name, user_id)
+    if habit is None:
+        print(f"Habit '{name}' not found.")
+        return
+    cursor = get_user_connection(user_id).execute(
+        "SELECT completed_at FROM completions WHERE habit_id = ? ORDER BY completed_at", (habit.id,))
+    for rows in _fetch_batches(cursor):
+        for row in rows:
+            yield row[0]
 
-def get_habits_by_periodicity(periodicity) -> Habit:
+
+def get_completed_habits(name, user_id=DEFAULT_USER_ID):
+    """
+    Returns completed habits that are used for analytics calculation.
+    """
+    return list(iter_completed_habits(name, user_id))
+
+
+def iter_completion_batches(habit_id, user_id=DEFAULT_USER_ID, size=None):
     """
-    Returns a list of habits by periodicity.
+    Streams (completed_epoch, completed_day) of a habit's completions in completion order, ready for analytics,
+    as lists of at most size (default FETCH_SIZE) rows.
     """
-    with create_connection() as connection:
+    cursor = get_user_connection(user_id).execute(
+        "SELECT completed_epoch, completed_day FROM completions WHERE habit_id = ? ORDER BY completed_epoch",
+        (habit_id,))
+    yield from _fetch_batches(cursor, size)
+
+
+def get_streak_state(habit_id, user_id=DEFAULT_USER_ID):
+    """
+    Returns the persisted (last_key, last_epoch, last_day, current_run, longest_run) of a habit, or None.
+    """
+    with get_user_connection(user_id) as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT * FROM habits WHERE periodicity = ?", (periodicity,))
-        row = cursor.fetchall()
-        return row
+        cursor.execute(
+            "SELECT last_key, last_epoch, last_day, current_run, longest_run FROM streak_state WHERE habit_id = ?",
+            (habit_id,))
+        return cursor.fetchone()
 
 
-def get_all_habits():
+def get_all_streak_states(user_id=DEFAULT_USER_ID):
     """
-    Returns a list of all habits.
+    Returns the persisted streak state of every habit of the user, keyed by habit id.
     """
-    with create_connection() as connection:
+    with get_user_connection(user_id) as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT * FROM habits")
-        rows = cursor.fetchall()
-        return [
-            Habit(id=row[0], name=row[1], description=row[2], priority=row[3], periodicity=row[4], created_at=row[5])
-            for row in rows]
+        cursor.execute("""
+            SELECT habit_id, last_key, last_epoch, last_day, current_run, longest_run
+            FROM streak_state
+            JOIN habits ON habits.id = streak_state.habit_id
+            WHERE habits.user_id = ?
+            """, (user_id,))
+        return {row[0]: row[1:] for row in cursor}
 
 
-def check_off_habit(name):
+def count_missing_streak_states(user_id=DEFAULT_USER_ID) -> int:
     """
-    Checks off a habit as done today.
+    Returns how many of the user's habits with completions have no persisted streak state.
     """
-    with create_connection() as connection:
+    with get_user_connection(user_id) as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT id FROM habits WHERE lower(name) = lower(?)", (name,))
-        row = cursor.fetchone()
-        if row is None:
-            print(f"Habit '{name}' not found.")
-            return
-        habit_id = row[0]
+        cursor.execute("""
+            SELECT COUNT(*) FROM habits
+            WHERE user_id = ?
+                AND NOT EXISTS (SELECT 1 FROM streak_state WHERE streak_state.habit_id = habits.id)
+                AND EXISTS (SELECT 1 FROM completions WHERE completions.habit_id = habits.id)
+            """, (user_id,))
+        return cursor.fetchone()[0]
+
 
+def save_streak_state(habit_id, state, user_id=DEFAULT_USER_ID):
+    """
+    Stores a streak state recomputed from completions, unless a newer completion arrived meanwhile.
+    """
+    last_key, last_epoch, last_day, current_run, longest_run = state
+    with get_user_connection(user_id) as connection:
+        cursor = connection.cursor()
         cursor.execute("""
-            SELECT 1 FROM completions
-            WHERE habit_id = ?
-                AND DATE(completed_at) = DATE('now', 'localtime')
-            LIMIT 1
-            """, (habit_id,))
-        if cursor.fetchone():
-            print(f"Habit '{name}' already checked.")
-            return
-
-        habit_id = row[0]
-        cursor.execute("INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)",
-                       (habit_id, datetime.now().replace(microsecond=0).isoformat()))
+            INSERT OR REPLACE INTO streak_state (habit_id, last_key, last_epoch, last_day, current_run, longest_run)
+            SELECT ?, ?, ?, ?, ?, ?
+            WHERE (SELECT MAX(completed_epoch) FROM completions WHERE habit_id = ?) = ?
+            """, (habit_id, last_key, last_epoch, last_day, current_run, longest_run, habit_id, last_epoch))
         connection.commit()
-        print(f"Habit '{name}' checked off.")
 
 
-def get_completed_habits(name):
+def _next_streak_state(periodicity, state, completed):
     """
-    Returns completed habits that are used for analytics calculation.
+    Advances a habit's streak state in O(1) by a completion appended after it.
+    Returns None for a missing state or an out-of-order completion, which leaves the state to be recomputed.
+    """
+    if state is None:
+        return None
+    last_key, last_epoch, last_day, current_run, longest_run = state
+    convert_day_to_period_key, step_size_between_periods = period_key_function(periodicity)
+    day = completed.toordinal()
+    epoch = int(epoch_seconds(completed))
+    key = convert_day_to_period_key(day)
+    if epoch < last_epoch or key < last_key:
+        return None
+
+    if key == last_key:
+        run = current_run
+    elif key - last_key == step_size_between_periods:
+        run = current_run + 1
+    else:
+        run = 1
+    return key, epoch, day, run, max(longest_run, run)
+
+
+def rebuild_streak_states(compute_state, user_id=DEFAULT_USER_ID) -> int:
+    """
+    Recomputes the streak state of every habit of the user from its period rollups in one write transaction.
+    compute_state(rows, periodicity) receives the (completed_epoch, completed_day) of the last completion
+    of every completed period of a habit, in order.
+    Returns the number of habits with a streak state.
+    """
+    with get_user_connection(user_id) as connection:
+        cursor = connection.cursor()
+        connection.commit()
+        cursor.execute("BEGIN IMMEDIATE")
+        periodicity_by_id = dict(
+            cursor.execute("SELECT id, periodicity FROM habits WHERE user_id = ?", (user_id,)).fetchall())
+        states = []
+        rollups = connection.execute("""
+            SELECT period_rollups.habit_id, last_epoch, last_day FROM period_rollups
+            JOIN habits ON habits.id = period_rollups.habit_id
+            WHERE habits.user_id = ?
+            ORDER BY period_rollups.habit_id, period_key
+            """, (user_id,))
+        for habit_id, rows in groupby(rollups, key=itemgetter(0)):
+            if habit_id in periodicity_by_id:
+                state = compute_state(map(itemgetter(1, 2), rows), periodicity_by_id[habit_id])
+                if state is not None:
+                    states.append((habit_id, *state))
+        cursor.execute("DELETE FROM streak_state WHERE habit_id IN (SELECT id FROM habits WHERE user_id = ?)",
+                       (user_id,))
+        cursor.executemany("""
+            INSERT INTO streak_state (habit_id, last_key, last_epoch, last_day, current_run, longest_run)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """, states)
+        connection.commit()
+        return len(states)
+
+
+# SQL for the period key of a completion (see periods.period_key_function), from its day ordinal.
+# A day ordinal plus 1721424.5 is the Julian day SQLite's date functions take.
+PERIOD_KEY_SQL = {
+    "daily": "completed_day",
+    "weekly": "completed_day - (completed_day - 1) % 7",
+    "monthly": "CAST(strftime('%Y', completed_day + 1721424.5) AS INTEGER) * 12"
+               " + CAST(strftime('%m', completed_day + 1721424.5) AS INTEGER)",
+}
+
+# Histogram buckets: weekday 0 is Monday like date.weekday(), month 0 is January.
+COMPLETION_BUCKET_SQL = {
+    "weekday": "(completed_day - 1) % 7",
+    "month": "CAST(strftime('%m', completed_day + 1721424.5) AS INTEGER) - 1",
+}
+
+
+def _period_key_case(periodicity):
+    """
+    SQL for the period key of completed_day under the periodicity held in the given SQL expression.
+    """
+    return f"""CASE {periodicity}
+        WHEN 'daily' THEN {PERIOD_KEY_SQL["daily"]}
+        WHEN 'weekly' THEN {PERIOD_KEY_SQL["weekly"]}
+        ELSE {PERIOD_KEY_SQL["monthly"]} END"""
+
+
+def summarize_completed_periods(first_day, last_day, user_id=DEFAULT_USER_ID):
+    """
+    Returns {habit_id: (distinct periods completed, first completed_day, last completed_day)} over the
+    completions whose day ordinal lies in first_day..last_day, aggregated in SQL.
+    """
+    with get_user_connection(user_id) as connection:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            SELECT completions.habit_id, COUNT(DISTINCT {_period_key_case("habits.periodicity")}),
+                MIN(completed_day), MAX(completed_day)
+            FROM completions
+            JOIN habits ON habits.id = completions.habit_id
+            WHERE completions.user_id = ? AND completed_day BETWEEN ? AND ?
+            GROUP BY completions.habit_id
+            """, (user_id, first_day, last_day))
+        return {row[0]: row[1:] for row in cursor}
+
+
+def count_completions_by(bucket, first_day, last_day, user_id=DEFAULT_USER_ID, habit_id=None):
+    """
+    Counts completions with day ordinals in first_day..last_day per "weekday" or "month" bucket,
+    for one habit or all of the user's habits. Returns {bucket: count}, leaving out empty buckets.
+    """
+    habit_filter = "" if habit_id is None else "AND habit_id = ?"
+    with get_user_connection(user_id) as connection:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            SELECT {COMPLETION_BUCKET_SQL[bucket]} AS bucket, COUNT(*)
+            FROM completions
+            WHERE user_id = ? AND completed_day BETWEEN ? AND ? {habit_filter}
+            GROUP BY bucket
+            """, (user_id, first_day, last_day, *([] if habit_id is None else [habit_id])))
+        return dict(cursor.fetchall())
+
+
+def rolling_completed_days(habit_id, first_day, last_day, window_days, user_id=DEFAULT_USER_ID):
+    """
+    Returns (day ordinal, days with a completion in the window_days ending that day) for every day in
+    first_day..last_day, including days without completions, computed with an SQL window function.
+    """
+    with get_user_connection(user_id) as connection:
+        cursor = connection.cursor()
+        cursor.execute("""
+            WITH RECURSIVE calendar(day) AS (
+                SELECT ? UNION ALL SELECT day + 1 FROM calendar WHERE day < ?
+            ),
+            completed(day) AS (
+                SELECT DISTINCT completed_day FROM completions
+                WHERE user_id = ? AND completed_day BETWEEN ? AND ? AND habit_id = ?
+            ),
+            rolling(day, completed_days) AS (
+                SELECT calendar.day, SUM(completed.day IS NOT NULL)
+                    OVER (ORDER BY calendar.day ROWS BETWEEN ? PRECEDING AND CURRENT ROW)
+                FROM calendar
+                LEFT JOIN completed ON completed.day = calendar.day
+            )
+            SELECT day, completed_days FROM rolling WHERE day >= ? ORDER BY day
+            """, (first_day - window_days + 1, last_day, user_id, first_day - window_days + 1, last_day, habit_id,
+                  window_days - 1, first_day))
+        return cursor.fetchall()
+
+
+def iter_period_rollup_batches(habit_id, user_id=DEFAULT_USER_ID, size=None):
+    """
+    Streams a habit's period rollups (period_key, completions, first_epoch, last_epoch, last_day) in period order,
+    one row per period with at least one completion, as lists of at most size (default FETCH_SIZE) rows.
+    """
+    cursor = get_user_connection(user_id).execute("""
+        SELECT period_key, completions, first_epoch, last_epoch, last_day FROM period_rollups
+        WHERE habit_id = ?
+        ORDER BY period_key
+        """, (habit_id,))
+    yield from _fetch_batches(cursor, size)
+
+
+def rebuild_period_rollups(user_id=DEFAULT_USER_ID) -> int:
+    """
+    Recomputes the period rollups of the user's habits from raw completions, e.g. after triggers were dropped.
+    Returns the number of rollup rows.
     """
-    with create_connection() as connection:
+    with get_user_connection(user_id) as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT id FROM habits WHERE name = ?", (name,))
-        row = cursor.fetchone()
-        if row is None:
-            print(f"Habit '{name}' not found.")
-            return []
-        habit_id = row[0]
-        cursor.execute("SELECT completed_at FROM completions WHERE habit_id = ? ORDER BY completed_at", (habit_id,))
-        rows = cursor.fetchall()
-        return [row[0] for row in rows]
+        cursor.execute("DELETE FROM period_rollups WHERE habit_id IN (SELECT id FROM habits WHERE user_id = ?)",
+                       (user_id,))
+        cursor.execute(f"""
+            INSERT INTO period_rollups (habit_id, period_key, completions, first_epoch, last_epoch, last_day)
+            SELECT completions.habit_id, {_period_key_case("habits.periodicity")},
+                COUNT(*), MIN(completed_epoch), MAX(completed_epoch), MAX(completed_day)
+            FROM completions
+            JOIN habits ON habits.id = completions.habit_id
+            WHERE habits.user_id = ?
+            GROUP BY 1, 2
+            """, (user_id,))
+        return cursor.rowcount
@@ -1,35 +1,25 @@
-class Habit:
-    def __init__(self, id, name, description, priority, periodicity, created_at):
-        self.__id = id
-        self.__name = name
-        self.__description = description
-        self.__priority = priority
-        self.__periodicity = periodicity
-        self.__created_at = created_at
+from typing import NamedTuple
 
-    def __str__(self):
-        return f'{self.__name}: {self.__description}, priority: {self.__priority}, periodicity: {self.__periodicity}, created_at: {self.__created_at}'
-
-    @property
-    def id(self):
-        return self.__id
 
-    @property
-    def name(self):
-        return self.__name
+class Habit(NamedTuple):
+    """
+    Immutable habit record. A tuple without a per-instance __dict__, in the column order of
+    database_api.HABIT_COLUMNS, so a database row becomes a Habit with Habit._make(row).
+    """
+    id: int
+    name: str
+    description: str
+    priority: int
+    periodicity: str
+    created_at: str
+    user_id: int = 1
 
-    @property
-    def description(self):
-        return self.__description
-
-    @property
-    def priority(self):
-        return self.__priority
+    def __str__(self):
+        return f'{self.name}: {self.description}, priority: {self.priority}, periodicity: {self.periodicity}, created_at: {self.created_at}'
 
-    @property
-    def periodicity(self):
-        return self.__periodicity
 
-    @property
-    def created_at(self):
-        return self.__created_at
+def habit_row_factory(cursor, row) -> Habit:
+    """
+    sqlite3 row_factory for queries selecting database_api.HABIT_COLUMNS.
+    """
+    return Habit._make(row)
@@ -0,0 +1,171 @@
+import argparse
+import csv
+import json
+import sys
+
+import database
+import database_api
+import instrumentation
+
+# Exit codes; argparse itself exits with 2 on invalid arguments.
+EXIT_OK = 0
+EXIT_NOT_FOUND = 1
+EXIT_INVALID = 2
+EXIT_EXISTS = 3
+
+# done --period values and the periodicity whose current period they select
+PERIODS = {"day": "daily", "week": "weekly", "month": "monthly"}
+
+HABIT_FIELDS = ["id", "name", "description", "priority", "periodicity", "created_at"]
+
+
+def _habit_record(habit) -> dict:
+    return {field: getattr(habit, field) for field in HABIT_FIELDS}
+
+
+def write_records(records, output_format, fields, output=None):
+    """
+    Writes a list of dicts as one JSON array, as CSV with a header row, or as one human-readable line each.
+    """
+    output = output or sys.stdout
+    if output_format == "json":
+        output.write(json.dumps(records) + "\n")
+    elif output_format == "csv":
+        writer = csv.DictWriter(output, fieldnames=fields, lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(records)
+    else:
+        for record in records:
+            output.write(", ".join(f"{field}: {record[field]}" for field in fields) + "\n")
+
+
+def create_command(arguments) -> int:
+    habit = database_api.add_habit(arguments.name, arguments.description, arguments.priority,
+                                   arguments.periodicity, arguments.user)
+    if habit is None:
+        print(f"Habit '{arguments.name}' already exists.", file=sys.stderr)
+        return EXIT_EXISTS
+    write_records([_habit_record(habit)], arguments.format, HABIT_FIELDS)
+    return EXIT_OK
+
+
+def check_command(arguments) -> int:
+    statuses = database_api.check_off_habits(arguments.names, arguments.user)
+    write_records([{"name": name, "status": status} for name, status in zip(arguments.names, statuses)],
+                  arguments.format, ["name", "status"])
+    return EXIT_NOT_FOUND if database_api.NOT_FOUND in statuses else EXIT_OK
+
+
+def list_command(arguments) -> int:
+    habits = database_api.iter_habits(arguments.user, arguments.periodicity)
+    write_records([_habit_record(habit) for habit in habits], arguments.format, HABIT_FIELDS)
+    return EXIT_OK
+
+
+def streaks_command(arguments) -> int:
+    import analytics  # pulls in NumPy, only needed here
+
+    streaks = analytics.parallel_streaks(arguments.user, arguments.workers)
+    write_records([{"name": habit.name, "periodicity": habit.periodicity, "longest": longest, "current": current}
+                   for habit, longest, current in streaks], arguments.format,
+                  ["name", "periodicity", "longest", "current"])
+    return EXIT_OK
+
+
+def today_command(arguments) -> int:
+    habits = database_api.get_habits_checked_on(database_api.user_now(arguments.user).date(), arguments.user)
+    write_records([_habit_record(habit) for habit in habits], arguments.format, HABIT_FIELDS)
+    return EXIT_OK
+
+
+def done_command(arguments) -> int:
+    habits = database_api.get_habits_completed_in(PERIODS[arguments.period], user_id=arguments.user)
+    write_records([_habit_record(habit) for habit in habits], arguments.format, HABIT_FIELDS)
+    return EXIT_OK
+
+
+def timezone_command(arguments) -> int:
+    if arguments.zone:
+        try:
+            database_api.set_timezone(arguments.zone, arguments.user)
+        except ValueError as error:
+            print(error, file=sys.stderr)
+            return EXIT_INVALID
+    write_records([{"user": arguments.user, "timezone": database_api.get_timezone(arguments.user) or "local"}],
+                  arguments.format, ["user", "timezone"])
+    return EXIT_OK
+
+
+def export_command(arguments) -> int:
+    import bulk
+
+    file_format = "csv" if arguments.format == "csv" else "jsonl"
+    if arguments.path == "-":
+        count = bulk.export_file(sys.stdout, file_format, user_id=arguments.user)
+    else:
+        with open(arguments.path, "w", newline="", encoding="utf-8") as output:
+            count = bulk.export_file(output, file_format, user_id=arguments.user)
+    print(f"Exported {count} records.", file=sys.stderr)
+    return EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Habit tracker for scripts: one action per call, no prompts.")
+    parser.add_argument("--database", help="path to the database (default: habits.db)")
+    parser.add_argument("--user", type=int, default=database.DEFAULT_USER_ID)
+    parser.add_argument("--format", choices=["text", "json", "csv"], default="text",
+                        help="output format; export writes JSONL unless csv is chosen")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create = commands.add_parser("create", help="create a habit")
+    create.add_argument("name")
+    create.add_argument("--description", default="")
+    create.add_argument("--priority", type=int, choices=range(1, 6), default=3)
+    create.add_argument("--periodicity", choices=["daily", "weekly", "monthly"], default="daily")
+    create.set_defaults(handler=create_command)
+
+    check = commands.add_parser("check", help="check off habits as done today")
+    check.add_argument("names", nargs="+")
+    check.set_defaults(handler=check_command)
+
+    list_parser = commands.add_parser("list", help="list habits")
+    list_parser.add_argument("--periodicity", choices=["daily", "weekly", "monthly"])
+    list_parser.set_defaults(handler=list_command)
+
+    streaks = commands.add_parser("streaks", help="longest and current streak of every habit")
+    streaks.add_argument("--workers", type=int, help="worker processes for large habit sets")
+    streaks.set_defaults(handler=streaks_command)
+
+    today = commands.add_parser("today", help="habits checked off today")
+    today.set_defaults(handler=today_command)
+
+    done = commands.add_parser("done", help="habits completed in the current day, ISO week or month")
+    done.add_argument("--period", choices=list(PERIODS), default="day")
+    done.set_defaults(handler=done_command)
+
+    timezone = commands.add_parser("timezone", help="show or set the user's timezone")
+    timezone.add_argument("zone", nargs="?", help="IANA name, e.g. Europe/Berlin")
+    timezone.set_defaults(handler=timezone_command)
+
+    export = commands.add_parser("export", help="write all habits and completions")
+    export.add_argument("path", nargs="?", default="-", help="output file, '-' for stdout")
+    export.set_defaults(handler=export_command)
+    return parser
+
+
+def main(argv=None) -> int:
+    """
+    Runs one subcommand and returns its exit code: 0 on success, 1 if a habit was not found,
+    2 for invalid arguments such as an unknown timezone, 3 if a habit to create already exists.
+    """
+    arguments = build_parser().parse_args(argv)
+    if arguments.database:
+        database.use_database(arguments.database)
+    # only reads PRAGMA user_version when the schema is current
+    database.create_table()
+    return arguments.handler(arguments)
+
+
+if __name__ == "__main__":
+    instrumentation.install_from_environment()
+    sys.exit(main())
@@ -0,0 +1,205 @@
+import atexit
+import functools
+import inspect
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import database
+
+# HABITS_PROFILE=text|json turns instrumentation on; HABITS_PROFILE_OUTPUT names a file for the summary
+# (stderr by default) and HABITS_PROFILE_INTERVAL dumps it every N seconds as well as on exit.
+ENVIRONMENT_VARIABLE = "HABITS_PROFILE"
+OUTPUT_VARIABLE = "HABITS_PROFILE_OUTPUT"
+INTERVAL_VARIABLE = "HABITS_PROFILE_INTERVAL"
+
+INSTRUMENTED_MODULES = ["database_api", "analytics"]
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+_lock = threading.Lock()
+_local = threading.local()
+_functions = {}
+_statements = {}
+_counters = {"connections_opened": 0}
+_enabled = False
+
+
+def _count_rows(result):
+    if result is None or isinstance(result, (bool, int, float, str)):
+        return 0
+    if isinstance(result, (list, dict, set)):
+        return len(result)
+    return 1
+
+
+def _record_function(name, seconds, rows):
+    with _lock:
+        stats = _functions.setdefault(name, {"calls": 0, "seconds": 0.0, "rows": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["rows"] += rows
+
+
+def _finish_statement(now):
+    """
+    Closes the timer of the statement last traced on this thread.
+    """
+    pending = getattr(_local, "statement", None)
+    if pending is not None:
+        sql, started = pending
+        _local.statement = None
+        with _lock:
+            stats = _statements.setdefault(sql, {"calls": 0, "seconds": 0.0})
+            stats["calls"] += 1
+            stats["seconds"] += now - started
+
+
+def _trace_statement(sql):
+    """
+    sqlite3 trace callback. SQLite only reports when a statement starts, so a statement's time
+    runs until the next statement on the thread or until the instrumented call returns.
+    """
+    now = time.perf_counter()
+    _finish_statement(now)
+    _local.statement = (_LITERALS.sub("?", " ".join(sql.split())), now)
+
+
+def _wrap_generator(name, generator, started):
+    rows = 0
+    try:
+        for row in generator:
+            rows += 1
+            yield row
+    finally:
+        _finish_statement(time.perf_counter())
+        _record_function(name, time.perf_counter() - started, rows)
+
+
+def _instrument(name, function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        result = function(*args, **kwargs)
+        if inspect.isgenerator(result):
+            return _wrap_generator(name, result, started)
+        _finish_statement(time.perf_counter())
+        _record_function(name, time.perf_counter() - started, _count_rows(result))
+        return result
+
+    return wrapper
+
+
+def _open_connection(original):
+    @functools.wraps(original)
+    def wrapper(path):
+        connection = original(path)
+        connection.set_trace_callback(_trace_statement)
+        with _lock:
+            _counters["connections_opened"] += 1
+        return connection
+
+    return wrapper
+
+
+def enable(output_format="text", output=None, interval=None):
+    """
+    Wraps every public function of the instrumented modules, traces SQLite statements and
+    dumps a summary on exit (and every `interval` seconds if given). Nothing is wrapped until this is called.
+    """
+    global _enabled
+    if _enabled:
+        return
+    _enabled = True
+
+    replacements = {}
+    main = sys.modules.get("__main__")
+    main_name = os.path.splitext(os.path.basename(getattr(main, "__file__", None) or ""))[0]
+    for module_name in INSTRUMENTED_MODULES:
+        # a module run as a script, e.g. python analytics.py, defines its functions in __main__
+        module, defined_in = (main, "__main__") if module_name == main_name else (__import__(module_name), module_name)
+        for name, value in list(vars(module).items()):
+            if (inspect.isfunction(value) and value.__module__ == defined_in and not name.startswith("_")
+                    and id(value) not in replacements):
+                replacements[id(value)] = _instrument(f"{module_name}.{name}", value)
+
+    # star imports copy the functions into other modules, so rebind them wherever they were imported
+    package_directory = os.path.dirname(os.path.abspath(__file__))
+    for module in list(sys.modules.values()):
+        module_file = getattr(module, "__file__", None) or ""
+        if os.path.dirname(os.path.abspath(module_file)) != package_directory:
+            continue
+        namespace = vars(module)
+        for name, value in list(namespace.items()):
+            if id(value) in replacements and inspect.isfunction(value):
+                namespace[name] = replacements[id(value)]
+
+    database._open_connection = _open_connection(database._open_connection)
+    with database._open_connections_lock:
+        for connection in database._open_connections:
+            connection.set_trace_callback(_trace_statement)
+
+    atexit.register(dump, output_format, output)
+    if interval:
+        _schedule(interval, output_format, output)
+
+
+def _schedule(interval, output_format, output):
+    def run():
+        dump(output_format, output)
+        _schedule(interval, output_format, output)
+
+    timer = threading.Timer(interval, run)
+    timer.daemon = True
+    timer.start()
+
+
+def summary() -> dict:
+    """
+    Returns the statistics collected so far.
+    """
+    with _lock:
+        return {
+            "connections_opened": _counters["connections_opened"],
+            "functions": {name: dict(stats) for name, stats in _functions.items()},
+            "statements": {sql: dict(stats) for sql, stats in _statements.items()},
+        }
+
+
+def format_text(stats) -> str:
+    lines = [f"Connections opened: {stats['connections_opened']}", "Functions (calls, total ms, rows):"]
+    for name, item in sorted(stats["functions"].items(), key=lambda entry: -entry[1]["seconds"]):
+        lines.append(f"  {name}: {item['calls']} calls, {item['seconds'] * 1000:.2f} ms, {item['rows']} rows")
+    lines.append("SQLite statements (calls, total ms):")
+    for sql, item in sorted(stats["statements"].items(), key=lambda entry: -entry[1]["seconds"]):
+        lines.append(f"  {item['calls']} calls, {item['seconds'] * 1000:.2f} ms: {sql}")
+    return "\n".join(lines)
+
+
+def dump(output_format="text", output=None):
+    """
+    Writes the summary as text or JSON to the output file, or to stderr.
+    """
+    stats = summary()
+    text = json.dumps(stats, indent=2) if output_format == "json" else format_text(stats)
+    if output:
+        with open(output, "w", encoding="utf-8") as target:
+            target.write(text + "\n")
+    else:
+        print(text, file=sys.stderr)
+
+
+def install_from_environment(flag=None):
+    """
+    Enables instrumentation when HABITS_PROFILE is set, or when a --profile[=json] flag was passed.
+    Call it from an entry point after the instrumented modules are imported.
+    """
+    setting = flag or os.environ.get(ENVIRONMENT_VARIABLE)
+    if not setting or setting == "0":
+        return
+    interval = os.environ.get(INTERVAL_VARIABLE)
+    enable("json" if setting == "json" else "text", os.environ.get(OUTPUT_VARIABLE),
+           float(interval) if interval else None)
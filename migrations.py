@@ -0,0 +1,418 @@
+import argparse
+import json
+import time
+
+import database
+
+# Rows copied per transaction when a migration rebuilds a table, so other connections
+# can read and write between batches instead of waiting for the whole copy.
+BATCH_SIZE = 50_000
+
+# Rows timed during a dry run to estimate how long each migration will take.
+DRY_RUN_SAMPLE_SIZE = 10_000
+
+# Normalized date columns derived from completions.completed_at, so "checked today" style
+# filters and period bucketing can be served by an index instead of scanning every row.
+COMPLETION_DATE_COLUMNS = {
+    "completed_date": "substr(completed_at, 1, 10)",
+    "completed_week": "date(completed_at, 'weekday 0', '-6 days')",
+    "completed_month": "substr(completed_at, 1, 7)",
+}
+
+# Integer forms of completed_at: seconds since 1970-01-01 of the stored wall-clock time and the
+# proleptic Gregorian day ordinal (date.toordinal()), so analytics never has to parse ISO text.
+COMPLETION_INTEGER_COLUMNS = {
+    "completed_epoch": "CAST(strftime('%s', completed_at) AS INTEGER)",
+    "completed_day": "CAST(julianday(substr(completed_at, 1, 10)) - 1721424.5 AS INTEGER)",
+}
+
+
+def _table_columns(connection, table):
+    return [row[1] for row in connection.execute(f"PRAGMA table_xinfo({table})")]
+
+
+def _table_exists(connection, table) -> bool:
+    row = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+    return row is not None
+
+
+def rebuild_table(connection, table, create_sql, columns, batch_size=BATCH_SIZE, after_swap=()):
+    """
+    Rebuilds a table with a new definition, copying rows by id in batches of batch_size.
+    Every batch is committed on its own; the final swap runs in the transaction left open for the caller.
+    create_sql must create the table named "{table}__rebuild". An interrupted rebuild resumes where it stopped.
+    Rows that other connections insert, update or delete between batches are logged by triggers in the database
+    and copied again at the swap, so they are not lost. Indexes and triggers on the old table are dropped with it;
+    recreate them in after_swap.
+    """
+    rebuild = f"{table}__rebuild"
+    log = f"{table}__rebuild_log"
+    column_list = ", ".join(columns)
+    connection.execute(create_sql)
+    connection.execute(f"CREATE TABLE IF NOT EXISTS {log} (id INTEGER PRIMARY KEY)")
+    for event, logged in [("INSERT", ["NEW"]), ("UPDATE", ["OLD", "NEW"]), ("DELETE", ["OLD"])]:
+        inserts = "\n".join(f"        INSERT OR IGNORE INTO {log} (id) VALUES ({row}.id);" for row in logged)
+        connection.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS {table}__rebuild_log_{event.lower()} AFTER {event} ON {table}
+    BEGIN
+{inserts}
+    END;
+    """)
+    last_id = connection.execute(f"SELECT COALESCE(MAX(id), 0) FROM {rebuild}").fetchone()[0]
+
+    while True:
+        cursor = connection.execute(
+            f"INSERT INTO {rebuild} ({column_list}) SELECT {column_list} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+            (last_id, batch_size))
+        if cursor.rowcount < batch_size:
+            break
+        last_id = connection.execute(f"SELECT MAX(id) FROM {rebuild}").fetchone()[0]
+        connection.commit()
+        connection.execute("BEGIN")
+
+    # the last batch holds the write lock, replay what changed in copied rows since they were copied
+    connection.execute(f"DELETE FROM {rebuild} WHERE id IN (SELECT id FROM {log})")
+    connection.execute(f"INSERT INTO {rebuild} ({column_list}) "
+                       f"SELECT {column_list} FROM {table} WHERE id IN (SELECT id FROM {log})")
+    connection.execute(f"DROP TABLE {log}")
+    # dropping the table forgets its AUTOINCREMENT counter, keep it so ids of deleted rows are not handed out again
+    sequence = None
+    if connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'").fetchone():
+        sequence = connection.execute("SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)).fetchone()
+    connection.execute(f"DROP TABLE {table}")
+    # triggers of other tables may refer to the dropped table; legacy mode renames without re-checking them
+    connection.execute("PRAGMA legacy_alter_table = ON")
+    try:
+        connection.execute(f"ALTER TABLE {rebuild} RENAME TO {table}")
+    finally:
+        connection.execute("PRAGMA legacy_alter_table = OFF")
+    if sequence is not None:
+        cursor = connection.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?", (sequence[0], table))
+        if cursor.rowcount == 0:
+            connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, sequence[0]))
+    for statement in after_swap:
+        connection.execute(statement)
+
+
+def _create_base_tables(connection, batch_size):
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS habits (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT UNIQUE NOT NULL,
+        description TEXT NOT NULL,
+        priority INTEGER NOT NULL,
+        periodicity TEXT CHECK(periodicity IN ('daily', 'weekly', 'monthly')) NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    """)
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS completions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        habit_id INTEGER NOT NULL,
+        completed_at TEXT NOT NULL,
+        FOREIGN KEY (habit_id) REFERENCES habits (id)
+    );
+    """)
+
+
+def _add_completion_date_columns(connection, batch_size):
+    existing_columns = set(_table_columns(connection, "completions"))
+    for column, expression in COMPLETION_DATE_COLUMNS.items():
+        if column not in existing_columns:
+            connection.execute(
+                f"ALTER TABLE completions ADD COLUMN {column} TEXT GENERATED ALWAYS AS ({expression}) VIRTUAL")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_completions_habit_date ON completions (habit_id, completed_date)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_completions_date_habit ON completions (completed_date, habit_id)")
+
+
+def _store_integer_timestamps(connection, batch_size):
+    date_columns = ",\n".join(f"        {column} TEXT GENERATED ALWAYS AS ({expression}) VIRTUAL"
+                               for column, expression in COMPLETION_DATE_COLUMNS.items())
+    integer_columns = ",\n".join(f"        {column} INTEGER GENERATED ALWAYS AS ({expression}) STORED"
+                                  for column, expression in COMPLETION_INTEGER_COLUMNS.items())
+    rebuild_table(connection, "completions", f"""
+    CREATE TABLE IF NOT EXISTS completions__rebuild (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        habit_id INTEGER NOT NULL,
+        completed_at TEXT NOT NULL,
+{date_columns},
+{integer_columns},
+        FOREIGN KEY (habit_id) REFERENCES habits (id)
+    );
+    """, ["id", "habit_id", "completed_at"], batch_size, after_swap=[
+        "CREATE INDEX IF NOT EXISTS idx_completions_habit_date ON completions (habit_id, completed_date)",
+        "CREATE INDEX IF NOT EXISTS idx_completions_date_habit ON completions (completed_date, habit_id)",
+        "CREATE INDEX IF NOT EXISTS idx_completions_habit_epoch "
+        "ON completions (habit_id, completed_epoch, completed_day)",
+    ])
+
+
+def _create_streak_state(connection, batch_size):
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS streak_state (
+        habit_id INTEGER PRIMARY KEY,
+        last_key INTEGER NOT NULL,
+        last_epoch INTEGER NOT NULL,
+        last_day INTEGER NOT NULL,
+        current_run INTEGER NOT NULL,
+        longest_run INTEGER NOT NULL
+    );
+    """)
+    # Any write that bypasses check_off_habit() drops the cached state; it is recomputed on the next read.
+    connection.execute("""
+    CREATE TRIGGER IF NOT EXISTS completions_insert_invalidates_streak AFTER INSERT ON completions
+    BEGIN
+        DELETE FROM streak_state WHERE habit_id = NEW.habit_id;
+    END;
+    """)
+    connection.execute("""
+    CREATE TRIGGER IF NOT EXISTS completions_delete_invalidates_streak AFTER DELETE ON completions
+    BEGIN
+        DELETE FROM streak_state WHERE habit_id = OLD.habit_id;
+    END;
+    """)
+    connection.execute("""
+    CREATE TRIGGER IF NOT EXISTS completions_update_invalidates_streak AFTER UPDATE ON completions
+    BEGIN
+        DELETE FROM streak_state WHERE habit_id IN (OLD.habit_id, NEW.habit_id);
+    END;
+    """)
+
+
+def _add_user_columns(connection, batch_size):
+    # habit names only have to be unique per user
+    rebuild_table(connection, "habits", """
+    CREATE TABLE IF NOT EXISTS habits__rebuild (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        description TEXT NOT NULL,
+        priority INTEGER NOT NULL,
+        periodicity TEXT CHECK(periodicity IN ('daily', 'weekly', 'monthly')) NOT NULL,
+        created_at TEXT NOT NULL,
+        user_id INTEGER NOT NULL DEFAULT 1,
+        UNIQUE (user_id, name)
+    );
+    """, ["id", "name", "description", "priority", "periodicity", "created_at"], batch_size, after_swap=[
+        "CREATE INDEX IF NOT EXISTS idx_habits_user_periodicity ON habits (user_id, periodicity)",
+    ])
+    if "user_id" not in _table_columns(connection, "completions"):
+        connection.execute("ALTER TABLE completions ADD COLUMN user_id INTEGER NOT NULL DEFAULT 1")
+    connection.execute("DROP INDEX IF EXISTS idx_completions_date_habit")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_completions_user_date ON completions (user_id, completed_date)")
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_completions_user_habit_epoch "
+                       "ON completions (user_id, habit_id, completed_epoch, completed_day)")
+
+
+def _index_habit_names_case_insensitively(connection, batch_size):
+    # names that already differ only in case keep working, the index is then not UNIQUE
+    duplicate = connection.execute(
+        "SELECT 1 FROM habits GROUP BY user_id, name COLLATE NOCASE HAVING COUNT(*) > 1 LIMIT 1").fetchone()
+    connection.execute(f"CREATE {'' if duplicate else 'UNIQUE '}INDEX IF NOT EXISTS idx_habits_user_name_nocase "
+                       "ON habits (user_id, name COLLATE NOCASE)")
+
+
+def _index_completion_days(connection, batch_size):
+    # covers the date-range aggregations of the windowed analytics without reading the table
+    connection.execute("CREATE INDEX IF NOT EXISTS idx_completions_user_day_habit "
+                       "ON completions (user_id, completed_day, habit_id)")
+
+
+def _period_key_sql(periodicity, day):
+    """
+    SQL for the period key of a day ordinal under a periodicity, as in periods.period_key_function.
+    """
+    return f"""CASE {periodicity}
+            WHEN 'daily' THEN {day}
+            WHEN 'weekly' THEN {day} - ({day} - 1) % 7
+            ELSE CAST(strftime('%Y', {day} + 1721424.5) AS INTEGER) * 12
+                + CAST(strftime('%m', {day} + 1721424.5) AS INTEGER) END"""
+
+
+def _recompute_rollup_sql(row):
+    """
+    Trigger statements recomputing the rollup of the period holding completion `row` (OLD or NEW).
+    A period spans at most 31 days, so only completions within 32 days of it are read.
+    """
+    return f"""
+        DELETE FROM period_rollups WHERE habit_id = {row}.habit_id AND period_key =
+            (SELECT {_period_key_sql("periodicity", f"{row}.completed_day")} FROM habits WHERE id = {row}.habit_id);
+        INSERT INTO period_rollups (habit_id, period_key, completions, first_epoch, last_epoch, last_day)
+        SELECT completions.habit_id, {_period_key_sql("habits.periodicity", "completed_day")},
+            COUNT(*), MIN(completed_epoch), MAX(completed_epoch), MAX(completed_day)
+        FROM completions
+        JOIN habits ON habits.id = completions.habit_id
+        WHERE completions.habit_id = {row}.habit_id
+            AND completed_epoch BETWEEN {row}.completed_epoch - 2764800 AND {row}.completed_epoch + 2764800
+            AND {_period_key_sql("habits.periodicity", "completed_day")}
+                = {_period_key_sql("habits.periodicity", f"{row}.completed_day")}
+        GROUP BY 1, 2;"""
+
+
+def _create_period_rollups(connection, batch_size):
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS period_rollups (
+        habit_id INTEGER NOT NULL,
+        period_key INTEGER NOT NULL,
+        completions INTEGER NOT NULL,
+        first_epoch INTEGER NOT NULL,
+        last_epoch INTEGER NOT NULL,
+        last_day INTEGER NOT NULL,
+        PRIMARY KEY (habit_id, period_key)
+    ) WITHOUT ROWID;
+    """)
+    # Every completion write keeps the rollup of its period current, whoever makes it.
+    connection.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS completions_insert_updates_rollup AFTER INSERT ON completions
+    BEGIN
+        INSERT INTO period_rollups (habit_id, period_key, completions, first_epoch, last_epoch, last_day)
+        SELECT NEW.habit_id, {_period_key_sql("periodicity", "NEW.completed_day")},
+            1, NEW.completed_epoch, NEW.completed_epoch, NEW.completed_day
+        FROM habits WHERE id = NEW.habit_id
+        ON CONFLICT (habit_id, period_key) DO UPDATE SET
+            completions = completions + 1,
+            first_epoch = MIN(first_epoch, excluded.first_epoch),
+            last_day = CASE WHEN excluded.last_epoch >= last_epoch THEN excluded.last_day ELSE last_day END,
+            last_epoch = MAX(last_epoch, excluded.last_epoch);
+    END;
+    """)
+    connection.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS completions_delete_updates_rollup AFTER DELETE ON completions
+    BEGIN{_recompute_rollup_sql("OLD")}
+    END;
+    """)
+    connection.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS completions_update_updates_rollup AFTER UPDATE OF habit_id, completed_at ON completions
+    BEGIN{_recompute_rollup_sql("OLD")}{_recompute_rollup_sql("NEW")}
+    END;
+    """)
+    connection.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS habits_periodicity_update_rebuilds_rollups AFTER UPDATE OF periodicity ON habits
+    WHEN NEW.periodicity != OLD.periodicity
+    BEGIN
+        DELETE FROM period_rollups WHERE habit_id = NEW.id;
+        INSERT INTO period_rollups (habit_id, period_key, completions, first_epoch, last_epoch, last_day)
+        SELECT habit_id, {_period_key_sql("NEW.periodicity", "completed_day")},
+            COUNT(*), MIN(completed_epoch), MAX(completed_epoch), MAX(completed_day)
+        FROM completions WHERE habit_id = NEW.id
+        GROUP BY 1, 2;
+    END;
+    """)
+    connection.execute("DELETE FROM period_rollups")
+    connection.execute(f"""
+    INSERT INTO period_rollups (habit_id, period_key, completions, first_epoch, last_epoch, last_day)
+    SELECT completions.habit_id, {_period_key_sql("habits.periodicity", "completed_day")},
+        COUNT(*), MIN(completed_epoch), MAX(completed_epoch), MAX(completed_day)
+    FROM completions
+    JOIN habits ON habits.id = completions.habit_id
+    GROUP BY 1, 2
+    """)
+
+
+def _add_timezones(connection, batch_size):
+    # completed_at stays wall-clock time in the user's zone, which every date column and rollup is derived from;
+    # utc_offset pins the instant (completed_epoch - utc_offset is UTC) and is NULL for rows written before
+    connection.execute("""
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id INTEGER PRIMARY KEY,
+        timezone TEXT NOT NULL
+    );
+    """)
+    if "utc_offset" not in _table_columns(connection, "completions"):
+        connection.execute("ALTER TABLE completions ADD COLUMN utc_offset INTEGER")
+
+
+def _drop_redundant_completion_indexes(connection, batch_size):
+    # "checked today" reads idx_completions_user_day_habit; habit-level reads, the rollup triggers and the
+    # user-wide streams (which go through habits) read idx_completions_habit_epoch. Each check-off then
+    # maintains two indexes fewer.
+    connection.execute("DROP INDEX IF EXISTS idx_completions_user_date")
+    connection.execute("DROP INDEX IF EXISTS idx_completions_user_habit_epoch")
+
+
+# (version, description, step, tables whose rows the step reads or rewrites)
+# Append new steps at the end; never renumber or edit a step that has shipped.
+MIGRATIONS = [
+    (1, "Create habits and completions tables", _create_base_tables, []),
+    (2, "Add generated date columns and indexes to completions", _add_completion_date_columns, ["completions"]),
+    (3, "Store completion timestamps as integer epoch seconds and day ordinals", _store_integer_timestamps,
+     ["completions"]),
+    (4, "Add incrementally maintained streak_state table", _create_streak_state, []),
+    (5, "Scope habits and completions to a user", _add_user_columns, ["habits"]),
+    (6, "Index habit names case-insensitively", _index_habit_names_case_insensitively, ["habits"]),
+    (7, "Index completions by user and day", _index_completion_days, ["completions"]),
+    (8, "Add per-habit period rollups maintained by triggers", _create_period_rollups, ["completions"]),
+    (9, "Add user timezones and the UTC offset of completions", _add_timezones, []),
+    (10, "Drop completion indexes no query uses", _drop_redundant_completion_indexes, []),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(connection) -> int:
+    """
+    Returns the schema version stored in PRAGMA user_version.
+    """
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _estimate(connection, tables):
+    """
+    Counts the rows a migration touches and times copying a sample of them into a temp table.
+    """
+    rows, seconds = 0, 0.0
+    for table in tables:
+        if not _table_exists(connection, table):
+            continue
+        table_rows = connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        sample = min(table_rows, DRY_RUN_SAMPLE_SIZE)
+        if sample:
+            connection.execute(f"CREATE TEMP TABLE dry_run_sample AS SELECT * FROM {table} LIMIT 0")
+            started = time.perf_counter()
+            connection.execute(f"INSERT INTO dry_run_sample SELECT * FROM {table} LIMIT ?", (sample,))
+            elapsed = time.perf_counter() - started
+            connection.execute("DROP TABLE dry_run_sample")
+            seconds += elapsed * table_rows / sample
+            connection.commit()  # only the temp schema was touched
+        rows += table_rows
+    return rows, seconds
+
+
+def migrate(path=None, dry_run=False, batch_size=BATCH_SIZE):
+    """
+    Applies every pending migration in order, each in its own transaction, and bumps user_version after each one.
+    With dry_run=True nothing is changed; the pending steps are returned with row counts and estimated seconds.
+    """
+    connection = database.get_connection(path)
+    version = current_version(connection)
+    report = []
+    for step_version, description, step, tables in MIGRATIONS:
+        if step_version <= version:
+            continue
+        if dry_run:
+            rows, seconds = _estimate(connection, tables)
+            report.append({"version": step_version, "description": description,
+                           "rows": rows, "estimated_seconds": round(seconds, 3)})
+            continue
+
+        started = time.perf_counter()
+        connection.commit()
+        connection.execute("BEGIN")
+        try:
+            step(connection, batch_size)
+            connection.execute(f"PRAGMA user_version = {step_version}")
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        report.append({"version": step_version, "description": description,
+                       "seconds": round(time.perf_counter() - started, 3)})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upgrade the habits database schema.")
+    parser.add_argument("--database", default=None, help="path to the database (default: habits.db)")
+    parser.add_argument("--dry-run", action="store_true", help="only report pending migrations")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows copied per transaction")
+    arguments = parser.parse_args()
+    print(json.dumps(migrate(arguments.database, arguments.dry_run, arguments.batch_size), indent=2))
@@ -0,0 +1,149 @@
+import time as clock
+from bisect import bisect_right
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+EPOCH = datetime(1970, 1, 1)
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+@lru_cache(maxsize=4096)
+def month_key(day_ordinal) -> int:
+    """
+    year * 12 + month of a day ordinal, so consecutive months are 1 apart.
+    """
+    day = date.fromordinal(day_ordinal)
+    return day.year * 12 + day.month
+
+
+def period_key_function(periodicity):
+    """
+    Returns the day ordinal -> period key function and the key distance between consecutive periods.
+    """
+    if periodicity == "daily":
+        return (lambda day_ordinal: day_ordinal), 1
+    if periodicity == "weekly":
+        # ordinal 1 (0001-01-01) is a Monday, so this is the ordinal of the Monday of that week
+        return (lambda day_ordinal: day_ordinal - (day_ordinal - 1) % 7), 7
+    return month_key, 1
+
+
+@lru_cache(maxsize=64)
+def period_calendar(periodicity, first_day, last_day) -> tuple:
+    """
+    Precomputed period keys of the day ordinals first_day..last_day; the key of day is calendar[day - first_day].
+    """
+    convert_day_to_period_key, _ = period_key_function(periodicity)
+    return tuple(map(convert_day_to_period_key, range(first_day, last_day + 1)))
+
+
+def period_ends(periodicity, first_date, last_date) -> list:
+    """
+    The last second (23:59:59 of the last day) of every daily, ISO-week or month period that ends
+    between first_date and last_date, plus last_date itself when its period is still running.
+    """
+    first_day, last_day = first_date.toordinal(), last_date.toordinal()
+    calendar = period_calendar(periodicity, first_day, last_day + 1)
+    return [datetime.combine(date.fromordinal(day), time(23, 59, 59))
+            for day in range(first_day, last_day + 1)
+            if day == last_day or calendar[day - first_day] != calendar[day + 1 - first_day]]
+
+
+def period_bounds(periodicity, day_ordinal) -> tuple:
+    """
+    First day ordinal of the day, ISO week or month containing day_ordinal, and the first day ordinal after it.
+    """
+    if periodicity == "daily":
+        return day_ordinal, day_ordinal + 1
+    if periodicity == "weekly":
+        monday = day_ordinal - (day_ordinal - 1) % 7
+        return monday, monday + 7
+    first = date.fromordinal(day_ordinal).replace(day=1)
+    return first.toordinal(), (first + timedelta(days=32)).replace(day=1).toordinal()
+
+
+def epoch_seconds(date_and_time) -> float:
+    """
+    Seconds since 1970-01-01 of a naive wall-clock datetime, the same scale as completions.completed_epoch.
+    """
+    return (date_and_time - EPOCH).total_seconds()
+
+
+def within_one_period(periodicity, most_recent_epoch, most_recent_day, now_datetime_object) -> bool:
+    """
+    Whether a streak whose last completion is most_recent is still running at now_datetime_object.
+    """
+    if periodicity == "daily":
+        return epoch_seconds(now_datetime_object) - most_recent_epoch <= SECONDS_PER_DAY
+    if periodicity == "weekly":
+        return epoch_seconds(now_datetime_object) - most_recent_epoch <= 7 * SECONDS_PER_DAY
+    return month_key(now_datetime_object.toordinal()) - month_key(most_recent_day) <= 1
+
+
+@lru_cache(maxsize=None)
+def _zone(zone_name):
+    return ZoneInfo(zone_name)
+
+
+def _offset_at(zone_name, utc_epoch) -> int:
+    """
+    UTC offset in seconds of zone_name at utc_epoch; None is the server's local zone.
+    """
+    if zone_name is None:
+        return clock.localtime(utc_epoch).tm_gmtoff
+    return int(datetime.fromtimestamp(utc_epoch, _zone(zone_name)).utcoffset().total_seconds())
+
+
+@lru_cache(maxsize=256)
+def utc_offset_table(zone_name, year) -> tuple:
+    """
+    (UTC epoch seconds at which each offset starts, offsets in seconds) of zone_name during year,
+    the first entry starting at 00:00 UTC on January 1. Built once per zone and year by probing
+    every day and bisecting each change down to the second.
+    """
+    start, end = int(epoch_seconds(datetime(year, 1, 1))), int(epoch_seconds(datetime(year + 1, 1, 1)))
+    starts, offsets = [start], [_offset_at(zone_name, start)]
+    previous = start
+    for probe in [*range(start + SECONDS_PER_DAY, end, SECONDS_PER_DAY), end - 1]:
+        offset = _offset_at(zone_name, probe)
+        if offset != offsets[-1]:
+            low, high = previous, probe
+            while high - low > 1:
+                middle = (low + high) // 2
+                if _offset_at(zone_name, middle) == offsets[-1]:
+                    low = middle
+                else:
+                    high = middle
+            starts.append(high)
+            offsets.append(offset)
+        previous = probe
+    return tuple(starts), tuple(offsets)
+
+
+def utc_offset(zone_name, utc_epoch) -> int:
+    """
+    UTC offset in seconds of zone_name (None for the server's local zone) at the instant utc_epoch.
+    """
+    starts, offsets = utc_offset_table(zone_name, (EPOCH + timedelta(seconds=utc_epoch)).year)
+    return offsets[bisect_right(starts, utc_epoch) - 1]
+
+
+def to_wall_clock(zone_name, moment):
+    """
+    Returns (naive wall-clock datetime in zone_name, its UTC offset in seconds) of a datetime.
+    An aware datetime is converted from its own zone; a naive one already is wall-clock time in zone_name.
+    """
+    if moment.tzinfo is None:
+        wall_clock_epoch = epoch_seconds(moment)
+        return moment, utc_offset(zone_name, wall_clock_epoch - utc_offset(zone_name, wall_clock_epoch))
+    instant = moment.timestamp()
+    offset = utc_offset(zone_name, instant)
+    return EPOCH + timedelta(seconds=instant + offset), offset
+
+
+def wall_clock_now(zone_name) -> datetime:
+    """
+    The current naive wall-clock time in zone_name.
+    """
+    return to_wall_clock(zone_name, datetime.now(timezone.utc))[0]
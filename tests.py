@@ -1,16 +1,40 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 from unittest.mock import patch
 
 from database_api import *
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from dateutil.relativedelta import relativedelta
-from database import create_connection
+import database
+from database import close_connection, create_connection, create_table, get_connection
 from analytics import *
+import benchmark
+from async_api import AsyncHabitStore
+import bulk
+import database_api
+import habit_cli
+import instrumentation
+from migrations import LATEST_VERSION, current_version, migrate, rebuild_table
+from periods import period_ends, utc_offset_table
+from zoneinfo import ZoneInfo
 from database_api import *
 
 TEST_HABIT_NAMES = ["TestHabitOne", "TestHabitTwo", "TestHabitThree"]
 
 
+def setUpModule():
+    create_table()
+
+
 def clean_habits(habit_names):
     for name in habit_names:
         remove_habit(name)
@@ -251,3 +275,722 @@ class TrackerTests(unittest.TestCase):
         self.assertEqual(current_streak(habit), 5)
 
         clean_habits(["MonthlyHabit"])
+
+    def test_connection_is_reused_per_thread(self):
+        self.assertIs(get_connection(), get_connection(), "Same thread should reuse its connection")
+
+        other = []
+        thread = threading.Thread(target=lambda: other.append(get_connection()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(other[0], get_connection(), "Each thread should get its own connection")
+
+        journal_mode = get_connection().execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(journal_mode.lower(), "wal")
+
+    def test_all_streaks_matches_single_habit_streaks(self):
+        clean_habits(["BatchDaily", "BatchWeekly"])
+        create_habit("BatchDaily", "d", 1, "daily")
+        create_habit("BatchWeekly", "w", 1, "weekly")
+        base = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        for d in [9, 8, 1, 0]:
+            insert_completion(get_habit_id("BatchDaily"), base - timedelta(days=d))
+        for w in [3, 1, 0]:
+            insert_completion(get_habit_id("BatchWeekly"), base - timedelta(weeks=w))
+
+        streaks = {habit.name: (longest, current) for habit, longest, current in all_streaks()}
+        for name in ["BatchDaily", "BatchWeekly"]:
+            habit = get_habit(name)
+            self.assertEqual(streaks[name], (longest_streak(habit), current_streak(habit)))
+        self.assertEqual(streaks["BatchDaily"], (2, 2))
+        self.assertGreaterEqual(max_overall_streak(), 2)
+        clean_habits(["BatchDaily", "BatchWeekly"])
+
+    def test_checked_today_queries_use_date_index(self):
+        with get_connection() as connection:
+            plan = connection.execute(
+                "EXPLAIN QUERY PLAN SELECT 1 FROM completions WHERE habit_id = ? AND completed_date = ?",
+                (1, "2025-01-01")).fetchall()
+        self.assertIn("USING INDEX idx_completions_", " ".join(row[-1] for row in plan))
+
+    def test_migrations_are_versioned_and_idempotent(self):
+        self.assertEqual(current_version(get_connection()), LATEST_VERSION)
+        self.assertEqual(migrate(), [], "A current database should have nothing to migrate")
+        self.assertEqual(migrate(dry_run=True), [])
+
+    def test_dry_run_and_batched_rebuild_on_old_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "old.db")
+            connection = get_connection(path)
+            connection.execute("CREATE TABLE habits (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL, "
+                               "description TEXT NOT NULL, priority INTEGER NOT NULL, periodicity TEXT NOT NULL, "
+                               "created_at TEXT NOT NULL)")
+            connection.execute("CREATE TABLE completions (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "habit_id INTEGER NOT NULL, completed_at TEXT NOT NULL)")
+            connection.executemany("INSERT INTO completions (habit_id, completed_at) VALUES (1, ?)",
+                                   [(f"2025-01-{day:02d}T09:00:00",) for day in range(1, 30)])
+            connection.executemany("INSERT INTO habits (name, description, priority, periodicity, created_at) "
+                                   "VALUES (?, '', 1, 'daily', '2025-01-01T08:00:00')", [("a",), ("b",), ("c",)])
+            connection.execute("DELETE FROM habits WHERE name = 'c'")
+            connection.execute("DELETE FROM completions WHERE id = 29")
+            connection.commit()
+
+            report = migrate(path, dry_run=True)
+            self.assertEqual(current_version(connection), 0, "Dry run must not change the schema")
+            self.assertEqual(next(step["rows"] for step in report if step["version"] == 3), 28)
+
+            migrate(path, batch_size=5)
+            self.assertEqual(current_version(connection), LATEST_VERSION)
+            # rebuilt tables keep their AUTOINCREMENT counters, ids of deleted rows are not reused
+            self.assertEqual(connection.execute(
+                "INSERT INTO habits (name, description, priority, periodicity, created_at) "
+                "VALUES ('d', '', 1, 'daily', '2025-01-01T08:00:00')").lastrowid, 4)
+            self.assertEqual(connection.execute(
+                "INSERT INTO completions (habit_id, completed_at) VALUES (1, '2025-02-01T09:00:00')").lastrowid, 30)
+            connection.execute("DELETE FROM completions WHERE id = 30")
+            connection.commit()
+            connection.execute("BEGIN")
+            rebuild_table(connection, "completions",
+                          "CREATE TABLE IF NOT EXISTS completions__rebuild (id INTEGER PRIMARY KEY, "
+                          "habit_id INTEGER NOT NULL, completed_at TEXT NOT NULL)",
+                          ["id", "habit_id", "completed_at"], batch_size=5)
+            connection.commit()
+            count = connection.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+            self.assertEqual(count, 28)
+            close_connection(path)
+
+    def test_rebuild_table_keeps_changes_made_between_batches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rebuild.db")
+            connection = sqlite3.connect(path)
+            connection.execute("CREATE TABLE items (id INTEGER PRIMARY KEY, value TEXT)")
+            connection.executemany("INSERT INTO items (value) VALUES (?)", [(str(i),) for i in range(1, 7)])
+            connection.commit()
+            writer = sqlite3.connect(path)
+
+            class WriteAfterFirstBatch:
+                """Lets another connection change already copied rows after the first batch is committed."""
+                commits = 0
+
+                def execute(self, *arguments):
+                    return connection.execute(*arguments)
+
+                def commit(self):
+                    connection.commit()
+                    self.commits += 1
+                    if self.commits == 1:
+                        writer.execute("DELETE FROM items WHERE id = 1")
+                        writer.execute("UPDATE items SET value = 'changed' WHERE id = 2")
+                        writer.execute("INSERT INTO items (id, value) VALUES (0, 'new')")
+                        writer.commit()
+
+            connection.execute("BEGIN")
+            rebuild_table(WriteAfterFirstBatch(), "items",
+                          "CREATE TABLE IF NOT EXISTS items__rebuild (id INTEGER PRIMARY KEY, value TEXT NOT NULL)",
+                          ["id", "value"], batch_size=2)
+            connection.commit()
+            self.assertEqual(connection.execute("SELECT id, value FROM items ORDER BY id").fetchall(),
+                             [(0, "new"), (2, "changed"), (3, "3"), (4, "4"), (5, "5"), (6, "6")])
+            self.assertEqual(connection.execute(
+                "SELECT name FROM sqlite_master WHERE name LIKE 'items__rebuild%'").fetchall(), [])
+            writer.close()
+            connection.close()
+
+    def test_completions_store_integer_epoch_and_day(self):
+        clean_habits(["IntegerTimes"])
+        create_habit("IntegerTimes", "i", 1, "daily")
+        moment = datetime(2024, 2, 29, 23, 59, 58)
+        insert_completion(get_habit_id("IntegerTimes"), moment)
+
+        rows = [row for rows in iter_completion_batches(get_habit_id("IntegerTimes")) for row in rows]
+        self.assertEqual(rows, [(int((moment - datetime(1970, 1, 1)).total_seconds()), moment.toordinal())])
+        clean_habits(["IntegerTimes"])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_numpy_backend_matches_reduce_backend(self):
+        names = ["VectorDaily", "VectorWeekly", "VectorMonthly"]
+        clean_habits(names)
+        base = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        for name, periodicity, offsets in [("VectorDaily", "daily", [0, 1, 2, 5, 6, 30, 31, 32, 33, 34]),
+                                           ("VectorWeekly", "weekly", [0, 6, 7, 14, 28, 35, 42, 400]),
+                                           ("VectorMonthly", "monthly", [0, 31, 62, 120, 150, 181, 700])]:
+            create_habit(name, "v", 1, periodicity)
+            for offset in offsets:
+                insert_completion(get_habit_id(name), base - timedelta(days=offset))
+
+        for name in names:
+            habit = get_habit(name)
+            results = {}
+            for backend in ["python", "numpy"]:
+                with patch("analytics.STREAK_BACKEND", backend):
+                    results[backend] = compute_streak_state(habit)
+                    for fetch_size in [1, 2, 3]:
+                        with patch("database_api.FETCH_SIZE", fetch_size):
+                            self.assertEqual(compute_streak_state(habit), results[backend], (name, fetch_size))
+            self.assertEqual(results["numpy"], results["python"], name)
+        clean_habits(names)
+
+    def test_streak_state_is_maintained_on_check_off_and_invalidated(self):
+        clean_habits(["StateHabit"])
+        create_habit("StateHabit", "s", 1, "daily")
+        habit = get_habit("StateHabit")
+        yesterday = datetime.now().replace(hour=0, minute=0, second=1, microsecond=0) - timedelta(days=1)
+        insert_completion(habit.id, yesterday - timedelta(days=1))
+        insert_completion(habit.id, yesterday)
+        self.assertIsNone(get_streak_state(habit.id), "Direct inserts should invalidate the state")
+
+        self.assertEqual(longest_streak(habit), 2)
+        self.assertIsNotNone(get_streak_state(habit.id), "Reading should store the recomputed state")
+
+        check_off_habit("StateHabit")
+        state = get_streak_state(habit.id)
+        self.assertEqual((state[3], state[4]), (3, 3), "Check-off should extend the stored run")
+        self.assertEqual(state, compute_streak_state(habit))
+        self.assertEqual(current_streak(habit), 3)
+
+        with patch("database_api.input", side_effect=["y", "StateHabit", "s"]):
+            with patch("database_api.prompt_priority", return_value=1):
+                with patch("database_api.prompt_periodicity", return_value="weekly"):
+                    update_habit("StateHabit")
+        self.assertIsNone(get_streak_state(habit.id), "Changing periodicity should invalidate the state")
+
+        self.assertGreaterEqual(rebuild_streak_state(), 1)
+        self.assertEqual(get_streak_state(habit.id), compute_streak_state(get_habit("StateHabit")))
+        clean_habits(["StateHabit"])
+
+    def test_bulk_export_and_import_round_trip(self):
+        clean_habits(["BulkHabit"])
+        create_habit("BulkHabit", "b", 2, "weekly")
+        base = datetime(2025, 3, 3, 9, 0, 0)
+        for week in range(3):
+            insert_completion(get_habit_id("BulkHabit"), base + timedelta(weeks=week))
+
+        with tempfile.TemporaryDirectory() as directory:
+            for file_format in ["jsonl", "csv"]:
+                path = os.path.join(directory, f"export.{file_format}")
+                with open(path, "w", newline="", encoding="utf-8") as output:
+                    bulk.export_file(output, file_format)
+                target = os.path.join(directory, f"import_{file_format}.db")
+                with patch("database.DATABASE", target):
+                    counts = bulk.import_file(path, chunk_size=2)
+                    self.assertEqual(counts["skipped"], 0)
+                    imported = get_habit("BulkHabit")
+                    self.assertEqual((imported.priority, imported.periodicity), (2, "weekly"))
+                    self.assertEqual(longest_streak(imported), 3)
+                    close_connection()
+        clean_habits(["BulkHabit"])
+
+    def test_bulk_import_matches_names_in_any_case_skips_known_days_and_rolls_back(self):
+        clean_habits(["Reading", "Broken"])
+        create_habit("Reading", "r", 1, "daily")
+        records = [{"type": "habit", "name": "reading", "description": "r", "priority": 1,
+                    "periodicity": "daily", "created_at": "2025-01-01T08:00:00"},
+                   {"type": "completion", "name": "READING", "completed_at": "2025-01-02T08:00:00"},
+                   {"type": "completion", "name": "Reading", "completed_at": "2025-01-02T20:00:00"}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "records.jsonl")
+            with open(path, "w", encoding="utf-8") as output:
+                output.writelines(json.dumps(record) + "\n" for record in records)
+            self.assertEqual(bulk.import_file(path), {"habits": 0, "completions": 1, "skipped": 2})
+            self.assertEqual(bulk.import_file(path)["completions"], 0)
+            self.assertEqual(len(get_completed_habits("Reading")), 1)
+
+            with open(path, "w", encoding="utf-8") as output:
+                output.write(json.dumps({"type": "habit", "name": "Broken", "description": "b", "priority": 1,
+                                         "periodicity": "daily", "created_at": "2025-01-01T08:00:00"}) + "\n")
+                output.write(json.dumps({"type": "completion"}) + "\n")
+            with self.assertRaises(KeyError):
+                bulk.import_file(path)
+            self.assertFalse(get_connection().in_transaction)
+            self.assertIsNone(get_habit("Broken"))
+        clean_habits(["Reading"])
+
+    def test_sql_dump_import_belongs_to_the_importing_user(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dump.sql")
+            with open(path, "w", encoding="utf-8") as output:
+                output.write("BEGIN TRANSACTION;\n"
+                             "INSERT INTO habits (name, description, priority, periodicity, created_at) "
+                             "VALUES ('DumpHabit', 'd', 1, 'daily', '2025-01-01T08:00:00');\n"
+                             "INSERT INTO completions (habit_id, completed_at) "
+                             "SELECT id, '2025-01-02T08:00:00' FROM habits WHERE name = 'DumpHabit';\n"
+                             "COMMIT;\n")
+            bulk.import_file(path, user_id=7)
+        self.assertIsNone(get_habit("DumpHabit"))
+        habit = get_habit("DumpHabit", 7)
+        self.assertEqual(get_completed_habits("DumpHabit", 7), ["2025-01-02T08:00:00"])
+        self.assertEqual(get_connection().execute(
+            "SELECT COUNT(*) FROM sqlite_temp_master WHERE type = 'trigger'").fetchone()[0], 0)
+        delete_habit(habit.name, 7)
+
+        # dumped habit ids that belong to other habits of the database are refused, not attached to them
+        clean_habits(["OwnedHabit"])
+        owned = add_habit("OwnedHabit", "o", 1, "daily")
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dump.sql")
+            with open(path, "w", encoding="utf-8") as output:
+                output.write("INSERT INTO habits (name, description, priority, periodicity, created_at) "
+                             "VALUES ('DumpHabit', 'd', 1, 'daily', '2025-01-01T08:00:00');\n"
+                             f"INSERT INTO completions (habit_id, completed_at) VALUES ({owned.id}, '2025-01-02T08:00:00');\n")
+            with self.assertRaisesRegex(sqlite3.IntegrityError, "does not own"):
+                bulk.import_file(path, user_id=7)
+        self.assertIsNone(get_habit("DumpHabit", 7))
+        self.assertEqual(get_completed_habits("OwnedHabit"), [])
+        self.assertEqual(get_connection().execute(
+            "SELECT COUNT(*) FROM sqlite_temp_master WHERE type = 'trigger'").fetchone()[0], 0)
+        clean_habits(["OwnedHabit"])
+
+    def test_benchmark_generates_and_reports(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.db")
+            completions = benchmark.generate_database(path, habits=6, completions=60, skip_rate=0.0)
+            self.assertEqual(completions, 60)
+            report = benchmark.run_benchmarks(path, samples=3)
+        self.assertEqual(report["habits"], 6)
+        for name in ["get_all_habits", "check_off_habit", "get_completed_habits", "longest_streak",
+                     "current_streak", "max_overall_streak"]:
+            self.assertIn("p99_ms", report["results"][name])
+        self.assertEqual(set(benchmark.compare(report, report)), set(report["results"]))
+
+    def test_instrumentation_wrapper_records_calls_rows_and_statements(self):
+        wrapped = instrumentation._instrument("tests.get_all_habits", get_all_habits)
+        streamed = instrumentation._instrument("tests.iter_completed_habits", iter_completed_habits)
+        connection = get_connection()
+        connection.set_trace_callback(instrumentation._trace_statement)
+        try:
+            habits = wrapped()
+            list(streamed("TestHabitOne"))
+        finally:
+            connection.set_trace_callback(None)
+
+        stats = instrumentation.summary()
+        self.assertEqual(stats["functions"]["tests.get_all_habits"]["calls"], 1)
+        self.assertEqual(stats["functions"]["tests.get_all_habits"]["rows"], len(habits))
+        self.assertIn("tests.iter_completed_habits", stats["functions"])
+        self.assertTrue(any(sql.startswith("SELECT id, name") and "FROM habits" in sql for sql in stats["statements"]))
+        self.assertIn("Functions", instrumentation.format_text(stats))
+
+    def test_async_store_batches_concurrent_check_offs(self):
+        clean_habits(["AsyncHabit", "AsyncRenamed"])
+
+        async def scenario():
+            async with AsyncHabitStore() as store:
+                habit = await store.create_habit("AsyncHabit", "a", 2, "daily")
+                self.assertEqual(habit.name, "AsyncHabit")
+                self.assertIsNone(await store.create_habit("AsyncHabit", "a", 2, "daily"))
+
+                statuses = await asyncio.gather(*[store.check_off("asynchabit") for _ in range(20)],
+                                                store.check_off("NoSuchHabit"))
+                self.assertEqual(statuses.count(CHECKED), 1)
+                self.assertEqual(statuses.count(ALREADY_CHECKED), 19)
+                self.assertEqual(statuses[-1], NOT_FOUND)
+
+                # a caller giving up before the flush must not keep the others of its batch waiting
+                cancelled = asyncio.create_task(store.check_off("AsyncHabit"))
+                waiting = asyncio.create_task(store.check_off("NoSuchHabit"))
+                await asyncio.sleep(0)
+                cancelled.cancel()
+                self.assertEqual(await asyncio.wait_for(waiting, timeout=5), NOT_FOUND)
+
+                renamed = await store.update_habit("AsyncHabit", name="AsyncRenamed", priority=4)
+                self.assertEqual((renamed.name, renamed.priority, renamed.periodicity), ("AsyncRenamed", 4, "daily"))
+                self.assertEqual(len(await store.get_completions("AsyncRenamed")), 1)
+                self.assertTrue(await store.remove_habit("AsyncRenamed"))
+
+        asyncio.run(scenario())
+        clean_habits(["AsyncHabit", "AsyncRenamed"])
+
+    def test_users_have_separate_habits_with_the_same_name(self):
+        other_user = 2
+        clean_habits(["SharedName"])
+        remove_habit("SharedName", other_user)
+        self.assertIsNotNone(add_habit("SharedName", "mine", 1, "daily"))
+        self.assertIsNotNone(add_habit("SharedName", "theirs", 3, "weekly", other_user))
+
+        self.assertEqual(check_off_habits(["SharedName"], other_user), [CHECKED])
+        self.assertEqual(get_completed_habits("SharedName"), [])
+        self.assertEqual(len(get_completed_habits("SharedName", other_user)), 1)
+        self.assertEqual(get_habit("SharedName", other_user).description, "theirs")
+        self.assertNotIn("SharedName", all_habit_names(3))
+        self.assertEqual([streaks[1] for streaks in all_streaks(other_user) if streaks[0].name == "SharedName"], [1])
+
+        self.assertTrue(delete_habit("SharedName", other_user))
+        self.assertEqual(get_habit("SharedName").description, "mine")
+        clean_habits(["SharedName"])
+
+    def test_shard_directory_routes_each_user_to_an_own_database(self):
+        with tempfile.TemporaryDirectory() as directory, patch("database.SHARD_DIRECTORY", directory):
+            add_habit("ShardHabit", "s", 1, "daily", user_id=7)
+            self.assertEqual(check_off_habits(["ShardHabit"], 7), [CHECKED])
+            path = os.path.join(directory, "user_7.db")
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(current_version(get_connection(path)), LATEST_VERSION)
+            self.assertEqual(all_habit_names(8), [])
+            close_connection(path)
+            close_connection(os.path.join(directory, "user_8.db"))
+        self.assertIsNone(get_habit("ShardHabit", 7))
+
+    def test_parallel_streaks_match_serial_streaks(self):
+        names = [f"ParallelHabit{number}" for number in range(6)]
+        clean_habits(names)
+        base = datetime.now() - timedelta(days=5)
+        for number, name in enumerate(names):
+            create_habit(name, "p", 1, "daily")
+            for day in range(number):
+                insert_completion(get_habit_id(name), base + timedelta(days=day + 5 - number + 1))
+
+        serial = {habit.name: (longest, current) for habit, longest, current in all_streaks()}
+        parallel = {habit.name: (longest, current) for habit, longest, current in parallel_streaks(workers=2, min_habits=0)}
+        self.assertEqual(parallel, serial)
+        self.assertEqual(parallel["ParallelHabit5"], (5, 5))
+        self.assertEqual(max_overall_streak(workers=2), max_overall_streak())
+        clean_habits(names)
+
+    def test_check_off_events_dedupes_per_day_in_one_batch(self):
+        clean_habits(["ReplayHabit"])
+        create_habit("ReplayHabit", "r", 1, "daily")
+        base = datetime.now().replace(hour=8, microsecond=0) - timedelta(days=3)
+        insert_completion(get_habit_id("ReplayHabit"), base)
+        longest_streak(get_habit("ReplayHabit"))  # persists a streak state the batch has to advance
+
+        statuses = check_off_events([
+            ("replayhabit", base + timedelta(hours=2)),
+            ("ReplayHabit", (base + timedelta(days=1)).isoformat()),
+            ("ReplayHabit", base + timedelta(days=1, hours=3)),
+            ("NoSuchHabit", base),
+            ("ReplayHabit", base + timedelta(days=2)),
+        ])
+        self.assertEqual(statuses, [ALREADY_CHECKED, CHECKED, ALREADY_CHECKED, NOT_FOUND, CHECKED])
+        habit = get_habit("ReplayHabit")
+        self.assertEqual(len(get_completed_habits("ReplayHabit")), 3)
+        self.assertIsNotNone(get_streak_state(habit.id))
+        self.assertEqual(get_streak_state(habit.id), compute_streak_state(habit))
+        clean_habits(["ReplayHabit"])
+
+    def test_habit_lookups_use_nocase_index_and_process_cache(self):
+        clean_habits(["CachedHabit", "RenamedCachedHabit"])
+        create_habit("CachedHabit", "c", 1, "daily")
+        self.assertIsNone(add_habit("cachedHABIT", "c", 1, "daily"), "Names are unique in any case")
+        plan = get_connection().execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM habits WHERE user_id = ? AND name = ? COLLATE NOCASE",
+            (1, "cachedhabit")).fetchall()
+        self.assertIn("idx_habits_user_name_nocase", " ".join(row[-1] for row in plan))
+
+        habit = get_habit("cachedhabit")
+        statements = []
+        get_connection().set_trace_callback(statements.append)
+        try:
+            self.assertIs(get_habit("CACHEDHABIT"), habit)
+            self.assertIs(get_habit(habit.id), habit)
+            self.assertIs(get_habit(str(habit.id)), habit)
+        finally:
+            get_connection().set_trace_callback(None)
+        # only the data version is checked, the habits table is not read
+        self.assertEqual([statement for statement in statements if not statement.startswith("PRAGMA")], [])
+
+        edit_habit(habit.id, name="RenamedCachedHabit")
+        self.assertIsNone(get_habit("CachedHabit"))
+        self.assertEqual(get_habit(habit.id).name, "RenamedCachedHabit")
+        self.assertTrue(delete_habit("renamedcachedhabit"))
+        self.assertIsNone(get_habit(habit.id))
+
+    def test_names_made_of_digits_are_never_taken_for_ids(self):
+        clean_habits(["DigitTarget"])
+        create_habit("DigitTarget", "d", 1, "daily")
+        target = get_habit("DigitTarget")
+        digits = str(target.id)
+        self.assertIsNotNone(add_habit(digits, "named like an id", 1, "daily"))
+        self.assertEqual(get_habit("DigitTarget"), target)
+        self.assertEqual(check_off_habits([digits]), [CHECKED])
+        self.assertEqual(len(get_completed_habits(digits)), 1)
+        self.assertEqual(get_completed_habits("DigitTarget"), [])
+        self.assertTrue(delete_habit(digits))
+        self.assertEqual(get_habit(target.id), target)
+        clean_habits(["DigitTarget"])
+
+    def test_habits_are_compact_immutable_records_streamed_lazily(self):
+        clean_habits(["CompactHabit"])
+        create_habit("CompactHabit", "c", 2, "monthly")
+        habit = get_habit("CompactHabit")
+        self.assertFalse(hasattr(habit, "__dict__"))
+        with self.assertRaises(AttributeError):
+            habit.name = "Changed"
+        self.assertEqual(str(habit), f"CompactHabit: c, priority: 2, periodicity: monthly, created_at: {habit.created_at}")
+
+        habits = iter_habits(periodicity="monthly")
+        self.assertNotIsInstance(habits, list)
+        self.assertIn(habit, list(habits))
+        self.assertIn(habit, get_habits_by_periodicity("monthly"))
+        self.assertEqual(list(iter_habits()), get_all_habits())
+        clean_habits(["CompactHabit"])
+
+    def test_windowed_completion_rates_histograms_and_rolling_counts(self):
+        clean_habits(["WindowDaily", "WindowWeekly"])
+        create_habit("WindowDaily", "w", 1, "daily")
+        create_habit("WindowWeekly", "w", 1, "weekly")
+        today = datetime(2025, 3, 30).date()  # a Sunday
+        for offset in [1, 2, 4, 5, 6, 40]:
+            insert_completion(get_habit_id("WindowDaily"), datetime(2025, 3, 30, 9) - timedelta(days=offset))
+        for offset in [0, 14]:
+            insert_completion(get_habit_id("WindowWeekly"), datetime(2025, 3, 30, 9) - timedelta(days=offset))
+
+        rates = {habit.name: rest for habit, *rest in completion_rates(days=7, today=today)}
+        # daily: done 5 of the 6 finished days, today is still open
+        self.assertEqual(rates["WindowDaily"], [5, 1, 5 / 6])
+        rates = {habit.name: rest for habit, *rest in completion_rates(days=21, today=today)}
+        # weekly: weeks of March 10, 17 and 24; the current week is done
+        self.assertEqual(rates["WindowWeekly"], [2, 1, 2 / 3])
+
+        daily = get_habit("WindowDaily")
+        self.assertEqual(weekday_histogram(habit=daily, today=today), [1, 2, 1, 0, 1, 1, 0])
+        self.assertEqual(month_histogram(habit=daily, today=today)[:3], [0, 1, 5])
+        self.assertEqual(sum(weekday_histogram(days=7, today=today)), sum(month_histogram(days=7, today=today)))
+        rolling = rolling_completions(daily, window_days=3, days=4, today=today)
+        self.assertEqual(rolling, [(today - timedelta(days=3), 2), (today - timedelta(days=2), 2),
+                                   (today - timedelta(days=1), 2), (today, 2)])
+        clean_habits(["WindowDaily", "WindowWeekly"])
+
+    def test_period_rollups_follow_completion_writes_and_rebuild(self):
+        clean_habits(["RollupHabit"])
+        create_habit("RollupHabit", "r", 1, "weekly")
+        habit_id = get_habit_id("RollupHabit")
+        monday = datetime(2025, 3, 3, 8)
+        for offset in [timedelta(0), timedelta(days=2), timedelta(days=7), timedelta(days=9, hours=5)]:
+            insert_completion(habit_id, monday + offset)
+
+        def rollups():
+            return [row for rows in iter_period_rollup_batches(habit_id) for row in rows]
+
+        week_key = monday.toordinal()
+        self.assertEqual([(key, count) for key, count, *_ in rollups()], [(week_key, 2), (week_key + 7, 2)])
+        self.assertEqual(rollups()[1][3:], (int(epoch_seconds(monday + timedelta(days=9, hours=5))),
+                                            (monday + timedelta(days=9)).toordinal()))
+
+        with get_connection() as connection:
+            connection.execute("DELETE FROM completions WHERE habit_id = ? AND completed_at = ?",
+                               (habit_id, (monday + timedelta(days=9, hours=5)).isoformat()))
+        self.assertEqual(rollups()[1][1:], (1, int(epoch_seconds(monday + timedelta(days=7))),
+                                            int(epoch_seconds(monday + timedelta(days=7))),
+                                            (monday + timedelta(days=7)).toordinal()))
+        self.assertEqual(longest_streak(get_habit("RollupHabit")), 2)
+
+        edit_habit("RollupHabit", periodicity="daily")
+        self.assertEqual(len(rollups()), 3)
+        trigger_maintained = rollups()
+        rebuild_period_rollups()
+        self.assertEqual(rollups(), trigger_maintained)
+        self.assertEqual(longest_streak(get_habit("RollupHabit")), 1)
+        clean_habits(["RollupHabit"])
+        self.assertEqual(rollups(), [])
+
+    def test_scriptable_cli_outputs_json_and_csv_with_exit_codes(self):
+        def run(*argv):
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(io.StringIO()):
+                code = habit_cli.main(["--database", path, *argv])
+            return code, output.getvalue()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cli.db")
+            try:
+                code, output = run("--format", "json", "create", "Stretch", "--periodicity", "weekly")
+                self.assertEqual((code, json.loads(output)[0]["periodicity"]), (habit_cli.EXIT_OK, "weekly"))
+                self.assertEqual(run("create", "stretch")[0], habit_cli.EXIT_EXISTS)
+
+                code, output = run("--format", "json", "check", "Stretch", "Missing")
+                self.assertEqual(code, habit_cli.EXIT_NOT_FOUND)
+                self.assertEqual(json.loads(output), [{"name": "Stretch", "status": CHECKED},
+                                                      {"name": "Missing", "status": NOT_FOUND}])
+                self.assertEqual(run("--format", "csv", "today")[1].splitlines()[1].split(",")[1], "Stretch")
+                code, output = run("--format", "json", "streaks")
+                self.assertEqual(json.loads(output)[0]["current"], 1)
+            finally:
+                close_connection(path)
+                database.use_database(None)
+
+            # a plain listing starts without importing the analytics stack
+            probe = ("import sys, habit_cli; code = habit_cli.main(['--database', sys.argv[1], 'list']); "
+                     "sys.exit(code + 10 * ('analytics' in sys.modules))")
+            result = subprocess.run([sys.executable, "-c", probe, path], capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertEqual(result.returncode, habit_cli.EXIT_OK, result.stderr)
+            self.assertIn("Stretch", result.stdout)
+
+    def test_snapshot_isolates_analytics_from_concurrent_writes(self):
+        clean_habits(["SnapshotHabit"])
+        create_habit("SnapshotHabit", "s", 1, "daily")
+        habit = get_habit("SnapshotHabit")
+        insert_completion(habit.id, datetime.now() - timedelta(days=1) + timedelta(minutes=1))
+
+        with database.snapshot():
+            self.assertTrue(database.in_snapshot())
+            writer = threading.Thread(target=check_off_habits, args=(["SnapshotHabit"],))
+            writer.start()
+            writer.join(timeout=5)
+            self.assertFalse(writer.is_alive(), "A snapshot must not block writers")
+            self.assertEqual(len(get_completed_habits("SnapshotHabit")), 1)
+            streaks = {habit.name: current for habit, _, current in all_streaks()}
+            self.assertEqual(streaks["SnapshotHabit"], 1)
+
+        self.assertFalse(database.in_snapshot())
+        self.assertEqual(len(get_completed_habits("SnapshotHabit")), 2)
+        self.assertEqual(current_streak(habit), 2)
+        clean_habits(["SnapshotHabit"])
+
+    def test_streak_series_matches_recomputing_at_every_point(self):
+        clean_habits(["AsOfHabit"])
+        create_habit("AsOfHabit", "a", 1, "weekly")
+        habit = get_habit("AsOfHabit")
+        completed = [datetime(2025, 1, 6, 8) + timedelta(weeks=week, days=week % 3) for week in [0, 1, 2, 4, 5, 6, 7]]
+        for completed_at in completed:
+            insert_completion(habit.id, completed_at)
+
+        points = period_ends("weekly", datetime(2025, 1, 1).date(), datetime(2025, 3, 5).date())
+        self.assertEqual((points[0], points[-1]), (datetime(2025, 1, 5, 23, 59, 59), datetime(2025, 3, 5, 23, 59, 59)))
+        series = streak_series(habit, points)
+        for point, longest, current in series:
+            rows = [(epoch_seconds(at), at.toordinal()) for at in completed if at <= point]
+            state = streak_state_from_completions(rows, "weekly")
+            expected_current = state[3] if state and within_one_period("weekly", state[1], state[2], point) else 0
+            self.assertEqual((longest, current), (state[4] if state else 0, expected_current), point)
+        self.assertEqual([current for _, _, current in series[:6]], [0, 1, 2, 3, 0, 1])
+        self.assertEqual(streak_as_of(habit, datetime(2025, 2, 26)), (4, 4))
+        self.assertEqual(current_streak(habit, as_of=datetime(2025, 1, 31)), 0)
+        clean_habits(["AsOfHabit"])
+
+    def test_user_timezone_decides_the_day_and_offset_of_check_offs(self):
+        user = 23
+        delete_habit("ZoneHabit", user)
+        with self.assertRaises(ValueError):
+            set_timezone("Mars/Olympus_Mons", user)
+        set_timezone("Pacific/Auckland", user)
+        create_habit("ZoneHabit", "z", 1, "daily", user)
+        # 23:30 UTC is 12:30 the next day in Auckland (UTC+13), the naive event is Auckland time on that day
+        statuses = check_off_events([("ZoneHabit", datetime(2025, 3, 30, 23, 30, tzinfo=timezone.utc)),
+                                     ("ZoneHabit", "2025-03-31T08:00:00")], user)
+        self.assertEqual(statuses, [CHECKED, ALREADY_CHECKED])
+        self.assertEqual([habit.name for habit in get_habits_checked_on(date(2025, 3, 31), user)], ["ZoneHabit"])
+        row = get_user_connection(user).execute(
+            "SELECT completed_at, utc_offset FROM completions WHERE user_id = ?", (user,)).fetchone()
+        self.assertEqual(row, ("2025-03-31T12:30:00", 13 * 3600))
+        exported = [record for record in bulk.iter_export_records(user) if record["type"] == "completion"]
+        self.assertEqual(exported[0]["completed_at"], "2025-03-31T12:30:00+13:00")
+
+        auckland_now = datetime.now(ZoneInfo("Pacific/Auckland")).replace(tzinfo=None)
+        self.assertLess(abs(user_now(user) - auckland_now), timedelta(seconds=5))
+        self.assertEqual(utc_offset_table("Europe/Berlin", 2025),
+                         ((1735689600, 1743296400, 1761440400), (3600, 7200, 3600)))
+        delete_habit("ZoneHabit", user)
+        with get_user_connection(user) as connection:
+            connection.execute("DELETE FROM user_settings WHERE user_id = ?", (user,))
+        clear_habit_cache()
+
+    def test_cached_reads_are_reused_until_data_changes(self):
+        clean_habits(["CachedHabit"])
+        first = cached_read(get_all_habits)
+        self.assertIs(cached_read(get_all_habits), first)
+        create_habit("CachedHabit", "c", 1, "weekly")
+        habits = cached_read(get_all_habits)
+        self.assertIn("CachedHabit", [habit.name for habit in habits])
+        self.assertIs(cached_read(habits_by_periodicity, "weekly"), cached_read(habits_by_periodicity, "weekly"))
+
+        today = user_now().date()
+        self.assertNotIn("CachedHabit", [habit.name for habit in cached_read(get_habits_checked_on, today)])
+        check_off_habit("CachedHabit")
+        self.assertIn("CachedHabit", [habit.name for habit in cached_read(get_habits_checked_on, today)])
+        self.assertEqual(cached_streaks(workers=1), all_streaks())
+
+        # a commit from another connection, e.g. another process, is noticed through PRAGMA data_version
+        habits = cached_read(get_all_habits)
+        writer = threading.Thread(target=lambda: get_connection().execute(
+            "UPDATE habits SET description = 'changed' WHERE name = 'CachedHabit'").connection.commit())
+        writer.start()
+        writer.join()
+        self.assertIsNot(cached_read(get_all_habits), habits)
+        self.assertEqual(get_habit("CachedHabit").description, "changed")
+
+        # neither may a habit another process removed still be checked off from the habit cache
+        writer = threading.Thread(target=lambda: get_connection().executescript(
+            "DELETE FROM completions WHERE habit_id IN (SELECT id FROM habits WHERE name = 'CachedHabit');"
+            "DELETE FROM habits WHERE name = 'CachedHabit';"))
+        writer.start()
+        writer.join()
+        self.assertEqual(check_off_habits(["CachedHabit"]), [NOT_FOUND])
+        clean_habits(["CachedHabit"])
+
+    def test_caches_are_not_trusted_by_connections_opened_after_a_write(self):
+        clean_habits(["Stale"])
+        remove_habit("Stale", 2)
+        create_habit("Stale", "old", 1, "daily")
+        self.assertEqual(get_habit("Stale").description, "old")
+        self.assertEqual(cached_read(get_habit, "Stale").description, "old")
+        with contextlib.closing(sqlite3.connect(database.DATABASE)) as other_process:
+            with other_process:
+                other_process.execute("UPDATE habits SET description = 'new' WHERE name = 'Stale'")
+
+        # a connection opened after the write starts counting PRAGMA data_version afresh
+        seen = []
+        reader = threading.Thread(target=lambda: seen.extend(
+            [get_habit("Stale").description, cached_read(get_habit, "Stale").description]))
+        reader.start()
+        reader.join()
+        self.assertEqual(seen, ["new", "new"])
+        close_connection()
+        self.assertEqual(get_habit("Stale").description, "new")
+        self.assertEqual(cached_read(get_habit, "Stale").description, "new")
+
+        # writes of another user leave the user's cached habits alone
+        habit = get_habit("Stale")
+        add_habit("Stale", "theirs", 1, "daily", 2)
+        check_off_habits(["Stale"], 2)
+        self.assertIs(get_habit("Stale"), habit)
+
+        cache = database_api._VersionedCache(2)
+        for key in "abc":
+            cache.put(key, 1, key)
+        self.assertEqual([cache.get(key, 1) for key in "abc"], [None, "b", "c"])
+        self.assertIsNone(cache.get("b", 2))
+        self.assertEqual(len(cache), 1, "stale entries are dropped")
+        remove_habit("Stale", 2)
+        clean_habits(["Stale"])
+
+    def test_habits_completed_in_a_period_use_a_day_range(self):
+        clean_habits(["RangeWeekly", "RangeMonthly"])
+        create_habit("RangeWeekly", "r", 1, "weekly")
+        create_habit("RangeMonthly", "r", 1, "monthly")
+        insert_completion(get_habit_id("RangeWeekly"), datetime(2025, 4, 28, 23, 59))  # Monday
+        insert_completion(get_habit_id("RangeMonthly"), datetime(2025, 5, 1, 0, 0))  # Thursday
+
+        def names(periodicity, day):
+            return [habit.name for habit in get_habits_completed_in(periodicity, day) if habit.name.startswith("Range")]
+
+        self.assertEqual(names("daily", date(2025, 4, 28)), ["RangeWeekly"])
+        self.assertEqual(names("weekly", date(2025, 5, 4)), ["RangeMonthly", "RangeWeekly"])
+        self.assertEqual(names("monthly", date(2025, 4, 1)), ["RangeWeekly"])
+        self.assertEqual(names("monthly", date(2025, 5, 31)), ["RangeMonthly"])
+        self.assertEqual([habit.name for habit in get_habits_checked_on(date(2025, 5, 1))
+                          if habit.name.startswith("Range")], ["RangeMonthly"])
+        plan = " ".join(row[3] for row in get_connection().execute(
+            "EXPLAIN QUERY PLAN " + HABITS_COMPLETED_BETWEEN_SQL, (1, 1, 0, 1)))
+        self.assertIn("idx_completions_user_day_habit", plan)
+        clean_habits(["RangeWeekly", "RangeMonthly"])
+
+    def test_completion_indexes_are_not_redundant_and_streams_need_no_sort(self):
+        indexes = {row[0] for row in get_connection().execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'completions'")}
+        self.assertNotIn("idx_completions_user_date", indexes)
+        self.assertNotIn("idx_completions_user_habit_epoch", indexes)
+        self.assertIn("idx_completions_habit_epoch", indexes)
+
+        statements = []
+        get_connection().set_trace_callback(statements.append)
+        try:
+            list(bulk.iter_export_records())
+        finally:
+            get_connection().set_trace_callback(None)
+        streams = [statement for statement in statements if "JOIN completions" in statement]
+        self.assertEqual(len(streams), 1)
+        for statement in streams:
+            plan = " ".join(row[3] for row in get_connection().execute("EXPLAIN QUERY PLAN " + statement))
+            self.assertNotIn("TEMP B-TREE", plan)
+